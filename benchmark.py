@@ -0,0 +1,233 @@
+"""
+Pruebas de rendimiento del flujo de cotización, fuera de Streamlit.
+
+Genera exportaciones sintéticas de MagicPlan (varios pisos, filas dañadas) y
+catálogos sintéticos de distintos tamaños, y mide por separado cada etapa:
+lectura del CSV, cálculo de propiedades, índice del catálogo, reglas de
+cantidad, resumen de cantidades y exportación a Excel (con plantilla y continua). Para cada etapa
+registra el tiempo, el rendimiento y el pico de memoria, y lo compara con una
+línea base guardada.
+
+Uso:
+    python benchmark.py                  # Compara contra benchmark_base.json
+    python benchmark.py --guardar-base   # Guarda los resultados como nueva base
+    python benchmark.py --rapido         # Solo los tamaños pequeños
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+# Sin servidor de Streamlit los decoradores de caché avisan al importar script
+logging.disable(logging.WARNING)
+import script  # noqa: E402
+logging.disable(logging.NOTSET)
+
+RUTA_BASE = "benchmark_base.json"
+TAMANOS_VIVIENDA = (10, 100, 500, 2000)
+TAMANOS_CATALOGO = (300, 1000, 5000)
+TOLERANCIA = 0.25  # Regresión si una etapa es 25 % más lenta que la base
+MARGEN_MINIMO = 0.005  # Segundos; diferencias menores se consideran ruido
+
+ENCABEZADO_MAGICPLAN = [
+    "PROPIEDADES HABITACIÓN", "Tierra Superficie: : m²", "Volumen: m³", "Tierra Perímetro: m",
+    "Techo Perímetro: m", "Paredes con apertura: m²", "Paredes sin apertura: m²",
+    "Superficie de las puertas: m²", "Superficie de ventanas: m²", "Altura del techo",
+]
+AREAS = [
+    "USUARIO", "MAGICPLAN - ÁREA PISO", "MAGICPLAN - ÁREA PARED", "MAGICPLAN - ÁREA CUBIERTA",
+    "MAGICPLAN - PERIMETRO PISO", "MAGICPLAN - PERIMETRO CUBIERTA",
+]
+
+
+def generar_csv_magicplan(n_habitaciones, pisos=3, fraccion_danadas=0.02, semilla=0):
+    """
+    Exportación sintética de MagicPlan con `n_habitaciones` repartidas en `pisos`.
+
+    Incluye títulos, secciones clave:valor y una fracción de filas dañadas
+    (valores no numéricos o campos de más).
+    """
+    rng = np.random.default_rng(semilla)
+    lineas = ["Proyecto sintético", "", "Nombre: Vivienda sintética,", f"Habitaciones: {n_habitaciones}", ""]
+    por_piso = np.array_split(np.arange(n_habitaciones), pisos)
+    for piso, habitaciones in enumerate(por_piso, start=1):
+        lineas += [f"PISO {piso}", "", ",".join(ENCABEZADO_MAGICPLAN)]
+        for h in habitaciones:
+            superficie = rng.uniform(2, 30)
+            perimetro = rng.uniform(6, 25)
+            techo = perimetro + rng.choice([0.0, rng.uniform(0.1, 3)])
+            altura = rng.uniform(2.2, 3.0)
+            paredes = perimetro * altura
+            valores = [superficie, superficie * altura, perimetro, techo, paredes,
+                       paredes * 0.85, rng.uniform(0, 4), rng.uniform(0, 3)]
+            campos = [f"{'#' if h % 2 == 0 else ''}HABITACION {piso}-{h}"]
+            campos += [f"{valor:.2f}" for valor in valores] + [f"{altura:.2f} m"]
+            danada = rng.random()
+            if danada < fraccion_danadas / 2:
+                campos[1] = "n/d"
+            elif danada < fraccion_danadas:
+                campos.append("sobrante")
+            lineas.append(",".join(campos))
+        lineas.append("")
+    return "\n".join(lineas).encode("utf-8")
+
+
+def generar_catalogo(n_actividades, por_categoria=15, semilla=0):
+    """Catálogo sintético con `n_actividades` filas en categorías de `por_categoria`."""
+    rng = np.random.default_rng(semilla)
+    columnas = {nombre: [] for nombre in script.CatalogoPrecios.COLUMNAS}
+    for fila in range(n_actividades):
+        categoria, posicion = divmod(fila, por_categoria + 1)
+        if posicion == 0:
+            valores = (str(categoria + 1), f"CATEGORIA SINTETICA {categoria + 1}", "", "", "", "", "", 0.0)
+        else:
+            por_altura = rng.random() < 0.05
+            valores = (
+                f"{categoria + 1}.{posicion}", f"Actividad sintética {categoria + 1}.{posicion}",
+                str(rng.choice(["UN", "M2", "ML", "M3"])),
+                "MAGICPLAN - ÁREA PISO" if por_altura else str(rng.choice(AREAS)),
+                "ÁREA PISO POR ALTURA LO DEFINE EL USUARIO - L*L*H" if por_altura else "",
+                "L*L*H" if por_altura else "", "",
+                float(rng.integers(5_000, 500_000)),
+            )
+        for nombre, valor in zip(script.CatalogoPrecios.COLUMNAS, valores):
+            columnas[nombre].append(valor)
+    return columnas
+
+
+def almacen_sintetico(catalogo, propiedades, fraccion=0.05, semilla=0):
+    """Almacén con una fracción de actividades elegidas en cada habitación."""
+    rng = np.random.default_rng(semilla)
+    habitaciones = [h for h in propiedades.keys() if "piso" not in h.lower()]
+    almacen = script.AlmacenCantidades(habitaciones, len(catalogo), activas=np.ones(len(habitaciones), bool))
+    actividades = np.flatnonzero(~catalogo.es_categoria)
+    elegidas = rng.random((len(habitaciones), len(actividades))) < fraccion
+    almacen.seleccion[:, actividades] = elegidas
+    almacen.cantidades[:, actividades] = np.where(elegidas, rng.uniform(0.5, 20, elegidas.shape), np.nan)
+    return almacen
+
+
+def medir(funcion, repeticiones):
+    """Mejor tiempo de `repeticiones` ejecuciones y pico de memoria de una de ellas."""
+    tracemalloc.start()
+    resultado = funcion()
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion()
+        tiempos.append(time.perf_counter() - inicio)
+    return resultado, min(tiempos), pico
+
+
+def ejecutar(tamanos_vivienda, tamanos_catalogo, repeticiones):
+    """
+    Corre todas las etapas para cada combinación de tamaños.
+
+    Returns:
+        dict: {"etapa/tamaño": {"segundos", "por_segundo", "pico_mb", "unidad"}}.
+    """
+    resultados = {}
+
+    def registrar(nombre, segundos, cantidad, unidad, pico):
+        resultados[nombre] = {
+            "segundos": round(segundos, 6),
+            "por_segundo": round(cantidad / segundos, 1) if segundos else None,
+            "unidad": unidad,
+            "pico_mb": round(pico / 2**20, 3),
+        }
+
+    plantilla = script.PlantillaReporte(script.ruta_plantilla)
+
+    for n_actividades in tamanos_catalogo:
+        columnas = generar_catalogo(n_actividades)
+        catalogo, segundos, pico = medir(lambda: script.CatalogoPrecios(columnas), repeticiones)
+        registrar(f"indice_catalogo/{n_actividades}", segundos, n_actividades, "filas", pico)
+
+        for n_habitaciones in tamanos_vivienda:
+            sufijo = f"{n_habitaciones}x{n_actividades}"
+            datos = generar_csv_magicplan(n_habitaciones)
+
+            (tablas, _), segundos, pico = medir(lambda: script.procesar_csv_bytes(script.BytesIO(datos)), repeticiones)
+            registrar(f"procesar_csv/{sufijo}", segundos, n_habitaciones, "habitaciones", pico)
+
+            propiedades, segundos, pico = medir(lambda: script.calcular_propiedades_habitacion(tablas), repeticiones)
+            registrar(f"propiedades/{sufijo}", segundos, n_habitaciones, "habitaciones", pico)
+
+            almacen = almacen_sintetico(catalogo, propiedades)
+            _, segundos, pico = medir(lambda: script.cantidades_por_defecto(
+                catalogo, propiedades, almacen.habitaciones, almacen.alturas), repeticiones)
+            registrar(f"reglas/{sufijo}", segundos, n_habitaciones * n_actividades, "celdas", pico)
+
+            resumen, segundos, pico = medir(lambda: script.construir_resumen(catalogo, almacen), repeticiones)
+            registrar(f"resumen/{sufijo}", segundos, n_habitaciones * n_actividades, "celdas", pico)
+
+            lineas = int((resumen["Total actividad"] > 0).sum())
+            _, segundos, pico = medir(lambda: script.export_to_excel(resumen, plantilla=plantilla), repeticiones)
+            registrar(f"exportar_excel/{sufijo}", segundos, lineas, "líneas", pico)
+
+            _, segundos, pico = medir(lambda: script.export_to_excel_continuo([("Vivienda", resumen)]), repeticiones)
+            registrar(f"exportar_continuo/{sufijo}", segundos, lineas, "líneas", pico)
+
+    return resultados
+
+
+def comparar(resultados, base):
+    """Lista de (etapa, tiempo actual, tiempo base) que empeoraron más que la tolerancia."""
+    regresiones = []
+    for nombre, actual in resultados.items():
+        anterior = base.get(nombre)
+        if not anterior:
+            continue
+        limite = max(anterior["segundos"] * (1 + TOLERANCIA), anterior["segundos"] + MARGEN_MINIMO)
+        if actual["segundos"] > limite:
+            regresiones.append((nombre, actual["segundos"], anterior["segundos"]))
+    return regresiones
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mide el rendimiento del flujo de cotización.")
+    parser.add_argument("--guardar-base", action="store_true", help="Guarda los resultados como línea base")
+    parser.add_argument("--base", default=RUTA_BASE, help="Archivo JSON de la línea base")
+    parser.add_argument("--rapido", action="store_true", help="Solo tamaños pequeños")
+    parser.add_argument("--repeticiones", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    tamanos_vivienda = TAMANOS_VIVIENDA[:2] if args.rapido else TAMANOS_VIVIENDA
+    tamanos_catalogo = TAMANOS_CATALOGO[:1] if args.rapido else TAMANOS_CATALOGO
+    resultados = ejecutar(tamanos_vivienda, tamanos_catalogo, args.repeticiones)
+
+    print(f"{'Etapa':<34}{'Segundos':>12}{'Rendimiento':>26}{'Pico MB':>10}")
+    for nombre, r in resultados.items():
+        rendimiento = f"{r['por_segundo']:,.0f} {r['unidad']}/s" if r["por_segundo"] else "-"
+        print(f"{nombre:<34}{r['segundos']:>12.4f}{rendimiento:>26}{r['pico_mb']:>10.2f}")
+
+    if args.guardar_base:
+        with open(args.base, "w", encoding="utf-8") as archivo:
+            json.dump(resultados, archivo, indent=2, ensure_ascii=False)
+        print(f"Línea base guardada en {args.base}")
+        return 0
+
+    if not os.path.exists(args.base):
+        print(f"No hay línea base ({args.base}); use --guardar-base para crearla.")
+        return 0
+
+    with open(args.base, encoding="utf-8") as archivo:
+        regresiones = comparar(resultados, json.load(archivo))
+    for nombre, actual, anterior in regresiones:
+        print(f"REGRESIÓN {nombre}: {actual:.4f} s (base {anterior:.4f} s)")
+    if not regresiones:
+        print("Sin regresiones respecto a la línea base.")
+    return 1 if regresiones else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,182 @@
+"""
+Cotización por lotes de viviendas sin interfaz.
+
+Toma una carpeta con los CSV de MagicPlan y una especificación JSON de
+actividades, cotiza cada vivienda, verifica el tope permitido y escribe un
+reporte por vivienda junto con un resumen del lote.
+
+Uso:
+    python cotizar_lote.py CARPETA_CSV --seleccion seleccion.json --salida reportes
+
+Con --continuo los reportes se escriben sin plantilla en modo de memoria
+constante (xlsxwriter), útil para viviendas con cientos de actividades. Con
+--consolidado ARCHIVO.xlsx además se escribe un solo reporte continuo con
+todas las viviendas dentro del tope.
+
+Formato de la especificación:
+    {
+        "porcentaje": 0,
+        "habitaciones": {
+            "*": {"1.3.3": null},
+            "#COCINA": {"1.1.8": 1}
+        }
+    }
+
+Las actividades se indican por código de ítem o por nombre. Una cantidad null
+usa la medida de MagicPlan de la actividad. Si junto a un CSV existe un JSON
+con el mismo nombre, ese archivo reemplaza la especificación general para esa
+vivienda.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from io import BytesIO
+
+import pandas as pd
+
+import script
+
+# Recursos cargados una vez por proceso trabajador
+_catalogo = None
+_plantilla = None
+
+
+def _iniciar_trabajador(ruta_catalogo, ruta_plantilla):
+    global _catalogo, _plantilla
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    _catalogo = script.cargar_catalogo(ruta_catalogo)
+    _plantilla = script.PlantillaReporte(ruta_plantilla)
+
+
+def cotizar_archivo(ruta_csv, especificacion, carpeta_salida, continuo=False, consolidado=False):
+    """
+    Cotiza una vivienda y escribe su reporte si está dentro del tope.
+
+    Args:
+        continuo (bool): Escribir el reporte sin plantilla, en modo de memoria constante.
+        consolidado (bool): Devolver también las actividades para el reporte consolidado.
+
+    Returns:
+        dict: Fila del resumen del lote (con "lineas" si `consolidado`).
+    """
+    nombre = os.path.splitext(os.path.basename(ruta_csv))[0]
+    resultado = {"vivienda": nombre, "habitaciones": 0, "total": 0.0, "maximo": 0.0,
+                 "estado": "", "reporte": "", "avisos": ""}
+
+    with open(ruta_csv, "rb") as archivo:
+        tablas, codigo = script.procesar_csv_bytes(BytesIO(archivo.read()))
+    if codigo != 200:
+        resultado["estado"] = "ERROR"
+        resultado["avisos"] = tablas["error"]
+        return resultado
+
+    propiedades = script.calcular_propiedades_habitacion(tablas)
+    if not len(propiedades):
+        resultado["estado"] = "ERROR"
+        resultado["avisos"] = "No se encontraron habitaciones en el CSV"
+        return resultado
+
+    almacen, avisos = script.cotizar_vivienda(_catalogo, propiedades, especificacion.get("habitaciones", {}))
+    avisos += [f"{fila.habitacion}: valor no numérico en '{fila.columna}'" for fila in propiedades.errores.itertuples()]
+
+    total = float(almacen.subtotales(_catalogo.valores).sum())
+    maximo = script.calcular_max_costo(float(especificacion.get("porcentaje", 0.0)))
+    resultado.update(habitaciones=int(almacen.activas.sum()), total=round(total, 2),
+                     maximo=round(maximo, 2), avisos="; ".join(avisos))
+
+    if total > maximo:
+        resultado["estado"] = "EXCEDE"
+        return resultado
+    if total <= 0:
+        resultado["estado"] = "SIN ACTIVIDADES"
+        return resultado
+
+    resumen = script.construir_resumen(_catalogo, almacen)
+    ruta_reporte = os.path.join(carpeta_salida, f"Reporte_{nombre}.xlsx")
+    if continuo:
+        script.export_to_excel_continuo([(nombre, resumen)], destino=ruta_reporte)
+    else:
+        with open(ruta_reporte, "wb") as archivo:
+            archivo.write(script.export_to_excel(resumen, plantilla=_plantilla))
+    resultado.update(estado="OK", reporte=ruta_reporte)
+    if consolidado:
+        resultado["lineas"] = resumen[resumen["Total actividad"] > 0]
+    return resultado
+
+
+def cargar_especificacion(ruta_csv, especificacion_general):
+    """Especificación propia de la vivienda (JSON junto al CSV) o la general."""
+    ruta_propia = os.path.splitext(ruta_csv)[0] + ".json"
+    if os.path.exists(ruta_propia):
+        with open(ruta_propia, encoding="utf-8") as archivo:
+            return json.load(archivo)
+    return especificacion_general
+
+
+def main(argv=None):
+    base = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Cotiza por lotes una carpeta de CSV de MagicPlan.")
+    parser.add_argument("carpeta", help="Carpeta con los CSV de MagicPlan")
+    parser.add_argument("--seleccion", required=True, help="Especificación JSON de actividades")
+    parser.add_argument("--salida", default="reportes", help="Carpeta de salida de los reportes")
+    parser.add_argument("--porcentaje", type=float, help="Porcentaje de reducción (reemplaza el de la especificación)")
+    parser.add_argument("--trabajadores", type=int, default=os.cpu_count(), help="Procesos en paralelo")
+    parser.add_argument("--catalogo", default=os.path.join(base, script.RUTA_ARCHIVO_COSTOS))
+    parser.add_argument("--plantilla", default=os.path.join(base, script.ruta_plantilla))
+    parser.add_argument("--continuo", action="store_true", help="Reportes sin plantilla en modo de memoria constante")
+    parser.add_argument("--consolidado", help="Reporte continuo único con todas las viviendas dentro del tope")
+    args = parser.parse_args(argv)
+
+    with open(args.seleccion, encoding="utf-8") as archivo:
+        especificacion = json.load(archivo)
+    if args.porcentaje is not None:
+        especificacion["porcentaje"] = args.porcentaje
+
+    rutas = sorted(
+        os.path.join(args.carpeta, nombre)
+        for nombre in os.listdir(args.carpeta)
+        if nombre.lower().endswith(".csv")
+    )
+    if not rutas:
+        print(f"No hay archivos CSV en {args.carpeta}", file=sys.stderr)
+        return 1
+    os.makedirs(args.salida, exist_ok=True)
+
+    resultados = []
+    with ProcessPoolExecutor(
+        max_workers=args.trabajadores,
+        initializer=_iniciar_trabajador,
+        initargs=(args.catalogo, args.plantilla),
+    ) as executor:
+        futuros = {
+            executor.submit(cotizar_archivo, ruta, cargar_especificacion(ruta, especificacion), args.salida,
+                            args.continuo, bool(args.consolidado)): ruta
+            for ruta in rutas
+        }
+        for futuro in as_completed(futuros):
+            try:
+                resultado = futuro.result()
+            except Exception as e:
+                nombre = os.path.splitext(os.path.basename(futuros[futuro]))[0]
+                resultado = {"vivienda": nombre, "estado": "ERROR", "avisos": str(e)}
+            resultados.append(resultado)
+            print(f"{resultado['vivienda']}: {resultado['estado']}")
+
+    lineas = {resultado["vivienda"]: resultado.pop("lineas") for resultado in resultados if "lineas" in resultado}
+    if args.consolidado:
+        ruta_consolidado = os.path.join(args.salida, args.consolidado)
+        script.export_to_excel_continuo(sorted(lineas.items()), destino=ruta_consolidado)
+        print(f"Reporte consolidado: {ruta_consolidado}")
+
+    df_resultados = pd.DataFrame(resultados).sort_values("vivienda")
+    ruta_resumen = os.path.join(args.salida, "resumen_lote.csv")
+    df_resultados.to_csv(ruta_resumen, index=False, encoding="utf-8-sig")
+    print(f"{(df_resultados['estado'] == 'OK').sum()} de {len(df_resultados)} viviendas dentro del tope. Resumen: {ruta_resumen}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,194 +1,1964 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import io
-from streamlit_pdf_viewer import pdf_viewer
 import re
+import csv
 import json
-from io import StringIO, BytesIO
-import base64
-from openpyxl import load_workbook
+from io import BytesIO
 import os
-import warnings
-import streamlit.components.v1 as components
+import hashlib
+import secrets
+import pickle
+import copy
+import ast
+import unicodedata
+import sys
+import threading
+import time
+import functools
+import contextvars
+from contextlib import contextmanager, nullcontext
+from collections import OrderedDict, deque
 
 ruta_plantilla = "Plantilla_Turbo_Final.xlsx"
 
+COLUMNA_ACTIVIDAD = "ACTIVIDAD DE OBRA - LISTA DE PRECIOS UNITARIOS"
+COLUMNA_VALOR = "Valor Unitario ofertado (**)"
+HOJA_COSTOS = "FORMATO DE OFERTA ECONÓMICA"
 
-def obtener_tabla_habitaciones():
-    if "costos_excel" in st.session_state:
-        df_costos = st.session_state["costos_excel"].copy()
-
-        # Filtrar solo las columnas necesarias
-        columnas_exportar = [
-            "Item",
-            "ACTIVIDAD DE OBRA - LISTA DE PRECIOS UNITARIOS",
-            "Unidad",
-            "Valor Unitario ofertado (**)"
-        ]
-        df_intermedio = df_costos[columnas_exportar].copy()
-
-        # -----------------------------------------------
-        # 1. Crear la columna 'Categoria' replicando la lógica de "categorias_actividades"
-        # -----------------------------------------------
-        categoria_actual = None
-        categorias = []
-        
-        for _, row in df_intermedio.iterrows():
-            actividad = str(row["ACTIVIDAD DE OBRA - LISTA DE PRECIOS UNITARIOS"])
-            # Si la actividad es mayúscula, asumimos que es una nueva categoría
-            if actividad.isupper():
-                categoria_actual = actividad
-                categorias.append(categoria_actual)
-            else:
-                # No es mayúscula, así que sigue perteneciendo a la última categoría
-                categorias.append(categoria_actual)
-        
-        df_intermedio["Categoria"] = categorias
+VALOR_MAXIMO = 15600000  # 15.600.000
+VALOR_DIAGNOSTICO = 1300000  # 1.300.000
+
+
+def calcular_max_costo(porcentaje=0.0):
+    """Costo permitido: valor máximo menos el diagnóstico, reducido en `porcentaje` %."""
+    return (VALOR_MAXIMO - VALOR_DIAGNOSTICO) * (100 - porcentaje) / 100
+
+
+MAX_EVENTOS_PERFIL = 5000  # Eventos que se conservan para exportar en JSON lines
+
+# Perfilador de la ejecución actual; None cuando la instrumentación está apagada.
+# Cada sesión de Streamlit corre en su propio hilo, así que no se mezclan.
+_perfil_actual = contextvars.ContextVar("perfil_actual", default=None)
+
+
+class Perfilador:
+    """
+    Tiempos por etapa, contadores y reruns de una sesión.
+
+    Solo se usa cuando el usuario activa la instrumentación; con ella apagada
+    las etapas medidas no hacen más que consultar `_perfil_actual`.
+    """
+
+    def __init__(self):
+        self.etapas = {}  # nombre -> [llamadas, total_s, maximo_s]
+        self.contadores = {}
+        self.reruns = 0
+        self.inicio = time.time()
+        self.eventos = deque(maxlen=MAX_EVENTOS_PERFIL)
+
+    @contextmanager
+    def medir(self, nombre):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.registrar_etapa(nombre, time.perf_counter() - inicio)
+
+    def registrar_etapa(self, nombre, duracion):
+        """Agrega una duración ya medida (p. ej. en un hilo de trabajo) a la etapa `nombre`."""
+        etapa = self.etapas.setdefault(nombre, [0, 0.0, 0.0])
+        etapa[0] += 1
+        etapa[1] += duracion
+        etapa[2] = max(etapa[2], duracion)
+        self.eventos.append({"tipo": "etapa", "nombre": nombre, "ms": round(duracion * 1000, 3),
+                             "rerun": self.reruns, "t": round(time.time(), 3)})
+
+    def contar(self, nombre, cantidad=1):
+        self.contadores[nombre] = self.contadores.get(nombre, 0) + cantidad
+
+    def registrar_rerun(self, duracion, bytes_sesion):
+        self.reruns += 1
+        self.eventos.append({"tipo": "rerun", "rerun": self.reruns, "ms": round(duracion * 1000, 3),
+                             "bytes_sesion": bytes_sesion, "t": round(time.time(), 3)})
+
+    def reruns_por_minuto(self):
+        return self.reruns * 60 / max(time.time() - self.inicio, 1e-9)
+
+    def tabla_etapas(self):
+        return pd.DataFrame(
+            [(nombre, llamadas, total * 1000, total * 1000 / llamadas, maximo * 1000)
+             for nombre, (llamadas, total, maximo) in self.etapas.items()],
+            columns=["Etapa", "Llamadas", "Total (ms)", "Promedio (ms)", "Máximo (ms)"],
+        ).sort_values("Total (ms)", ascending=False).round(2)
+
+    def a_jsonl(self):
+        return "\n".join(json.dumps(evento, ensure_ascii=False) for evento in self.eventos).encode("utf-8")
+
+
+def medir_etapa(nombre):
+    """Contexto que mide `nombre` si la instrumentación está activa (si no, no hace nada)."""
+    perfil = _perfil_actual.get()
+    return perfil.medir(nombre) if perfil else nullcontext()
+
+
+def contar(nombre, cantidad=1):
+    perfil = _perfil_actual.get()
+    if perfil:
+        perfil.contar(nombre, cantidad)
+
+
+def medido(nombre):
+    """Decorador: mide cada llamada de la función como la etapa `nombre`."""
+    def decorador(funcion):
+        @functools.wraps(funcion)
+        def envoltura(*args, **kwargs):
+            perfil = _perfil_actual.get()
+            if perfil is None:
+                return funcion(*args, **kwargs)
+            with perfil.medir(nombre):
+                return funcion(*args, **kwargs)
+        return envoltura
+    return decorador
+
+
+def tamano_objeto(valor):
+    """Tamaño aproximado en bytes de un valor guardado en la sesión."""
+    if isinstance(valor, (bytes, bytearray)):
+        return len(valor)
+    if isinstance(valor, np.ndarray):
+        return valor.nbytes
+    if isinstance(valor, (pd.DataFrame, pd.Series)):
+        return int(valor.memory_usage(deep=True).sum())
+    if isinstance(valor, AlmacenCantidades):
+        return valor.cantidades.nbytes + valor.seleccion.nbytes + valor.alturas.nbytes
+    if isinstance(valor, PropiedadesHabitaciones):
+        return valor.valores.nbytes + tamano_objeto(valor.errores)
+    if isinstance(valor, CarteraViviendas):
+        return tamano_objeto(valor.viviendas) + tamano_objeto(valor.lineas)
+    if isinstance(valor, dict):
+        return sum(tamano_objeto(v) for v in valor.values())
+    if isinstance(valor, (tuple, list)):
+        return sum(tamano_objeto(v) for v in valor)
+    return sys.getsizeof(valor)
+
+
+# Claves que no cuentan como memoria propia de la sesión: el perfilador y
+# referencias a objetos de las cachés compartidas (acotadas aparte)
+CLAVES_NO_CONTADAS = ("perfil", "catalogo", "resultados_csv")
+
+
+def tamano_sesion():
+    """Bytes aproximados que `st.session_state` retiene solo para esta sesión."""
+    return sum(tamano_objeto(valor) for clave, valor in st.session_state.items() if clave not in CLAVES_NO_CONTADAS)
+
+
+def memoria_proceso():
+    """
+    Memoria residente (RSS) actual y pico del proceso del servidor, en bytes.
+
+    Returns:
+        tuple: (actual, pico); (None, None) donde no hay /proc ni `resource` (Windows).
+    """
+    try:
+        import resource
+
+        with open("/proc/self/statm") as archivo:
+            actual = int(archivo.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # Linux lo da en KB
+    except (ImportError, OSError, ValueError):
+        return None, None
+    return actual, pico
+
+
+# ---------------------------------------------------------------------------
+# Presupuesto de memoria por sesión
+# ---------------------------------------------------------------------------
+# El catálogo, los CSV procesados, los bytes de los planos y sus páginas
+# dibujadas se comparten entre sesiones, en cachés acotadas por bytes
+# (cache_ingesta, cache_planos). Lo que cada sesión guarda aparte son las
+# cantidades (AlmacenCantidades) y algunos artefactos derivados que se pueden
+# volver a generar. Si la sesión supera el límite, esos artefactos se
+# descartan en este orden, del más pesado y barato de rehacer al que más
+# trabajo cuesta.
+
+MAX_MEMORIA_SESION = float(os.environ.get("MAX_MEMORIA_SESION_MB", 50)) * 2**20  # Bytes por sesión
+
+
+# (clave de la sesión, campo con el valor pesado o None para toda la clave, descripción)
+ARTEFACTOS_DESCARTABLES = (
+    ("reporte", "datos", "el reporte generado"),
+    ("ajuste", None, "el ajuste al presupuesto calculado"),
+    ("cartera", None, "la cartera consolidada"),
+)
+
+
+def aplicar_presupuesto_memoria(limite=MAX_MEMORIA_SESION):
+    """
+    Descarta artefactos derivados de la sesión hasta quedar dentro de `limite`.
+
+    Returns:
+        list: Descripción de los artefactos descartados, en orden.
+    """
+    descartados = []
+    tamano = tamano_sesion()
+    for clave, campo, descripcion in ARTEFACTOS_DESCARTABLES:
+        if tamano <= limite:
+            break
+        if clave not in st.session_state:
+            continue
+        if campo is None:
+            tamano -= tamano_objeto(st.session_state.pop(clave))
+        elif st.session_state[clave][campo] is not None:
+            tamano -= tamano_objeto(st.session_state[clave][campo])
+            st.session_state[clave][campo] = None
+        else:
+            continue
+        contar("artefactos_descartados")
+        descartados.append(descripcion)
+    return descartados
+
+
+def panel_instrumentacion(perfil):
+    """Panel plegable de la barra lateral con los datos del perfilador."""
+    with st.sidebar.expander("⏱️ Instrumentación"):
+        st.markdown(f"**Reruns:** {perfil.reruns} ({perfil.reruns_por_minuto():.1f} por minuto)")
+        st.markdown(f"**Estado de la sesión:** {tamano_sesion() / 2**20:,.2f} MB "
+                    f"de {MAX_MEMORIA_SESION / 2**20:,.0f} MB")
+        actual, pico = memoria_proceso()
+        if actual is not None:
+            st.markdown(f"**Memoria del servidor:** {actual / 2**20:,.0f} MB (pico {pico / 2**20:,.0f} MB)")
+        st.markdown(f"**Cachés compartidas:** archivos {cache_ingesta().bytes / 2**20:,.1f} MB, "
+                    f"planos {cache_planos().bytes / 2**20:,.1f} MB")
+        if perfil.etapas:
+            st.dataframe(perfil.tabla_etapas(), hide_index=True)
+        if perfil.contadores:
+            st.dataframe(pd.DataFrame(list(perfil.contadores.items()), columns=["Contador", "Valor"]),
+                         hide_index=True)
+        st.download_button("Exportar eventos (JSON lines)", perfil.a_jsonl(),
+                           file_name="instrumentacion.jsonl", mime="application/jsonl")
+
+
+VARIABLES_REGLA = {
+    "M": "medida",  # Medida de MagicPlan indicada en la columna ÁREA
+    "H": "altura",  # Altura de la habitación
+    "U": "valor ingresado",  # Cantidad o longitud que escribe el usuario
+}
+NODOS_REGLA = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Constant, ast.Name, ast.Load,
+               ast.Add, ast.Sub, ast.Mult, ast.Div, ast.UAdd, ast.USub)
+
+
+def alias_medida(medida):
+    """Nombre de variable de una medida: "MAGICPLAN - ÁREA PISO" -> "AREA_PISO"."""
+    texto = unicodedata.normalize("NFKD", medida.replace("MAGICPLAN - ", ""))
+    texto = texto.encode("ascii", "ignore").decode()
+    return re.sub(r"\W+", "_", texto.strip()).upper()
+
+
+def expresion_catalogo(area, medicion, regla):
+    """
+    Expresión de la regla de una actividad a partir de sus columnas en el Excel.
+
+    La columna REGLA, si existe y tiene valor, se usa tal cual. Si no, se
+    traduce la columna MEDICION: "L*L" es la medida de ÁREA (o el valor del
+    usuario si ÁREA es USUARIO), una "L" sola es una longitud que escribe el
+    usuario y "H" es la altura. Sin MEDICION, la cantidad es la medida de ÁREA.
+    """
+    if regla.strip():
+        return regla.strip().upper()
+    base = "U" if not area or "USUARIO" in area.upper() else "M"
+    if not medicion.strip():
+        return base
+    expresion = re.sub(r"\bL\s*\*\s*L\b", base, medicion.strip().upper())
+    return re.sub(r"\bL\b", "U", expresion)
+
+
+class ReglaCantidad:
+    """
+    Regla compilada que calcula la cantidad de una actividad.
+
+    Es una expresión aritmética (+, -, *, /, paréntesis y constantes) sobre
+    las variables de VARIABLES_REGLA y las medidas de MagicPlan por su alias
+    (AREA_PISO, PERIMETRO_CUBIERTA, ...). Se valida y compila una sola vez, y
+    se evalúa con arreglos de numpy: una evaluación da el valor para todas las
+    habitaciones.
+    """
+
+    def __init__(self, expresion, medida=None):
+        """
+        Args:
+            expresion (str): Expresión de la regla, p. ej. "M*H".
+            medida (str, optional): Medida de MagicPlan a la que se refiere M.
+
+        Raises:
+            ValueError: Si la expresión no es válida.
+        """
+        self.expresion = expresion
+        self.medida = medida
+        try:
+            arbol = ast.parse(expresion, mode="eval")
+        except SyntaxError:
+            raise ValueError(f"Expresión no válida: {expresion}")
+        for nodo in ast.walk(arbol):
+            if not isinstance(nodo, NODOS_REGLA):
+                raise ValueError(f"Elemento no permitido en la regla: {expresion}")
+            if isinstance(nodo, ast.Constant) and not isinstance(nodo.value, (int, float)):
+                raise ValueError(f"Constante no numérica en la regla: {expresion}")
+
+        self.variables = frozenset(nodo.id for nodo in ast.walk(arbol) if isinstance(nodo, ast.Name))
+        conocidas = set(VARIABLES_REGLA) | {alias_medida(m) for m in MEDIDAS_MAGICPLAN}
+        if self.variables - conocidas:
+            raise ValueError(f"Variables desconocidas en la regla: {', '.join(sorted(self.variables - conocidas))}")
+        if "M" in self.variables and not medida:
+            raise ValueError("La regla usa M pero la actividad no indica una medida de MagicPlan")
+
+        self.usa_usuario = "U" in self.variables
+        self.usa_altura = "H" in self.variables
+        self._codigo = compile(arbol, "<regla>", "eval")
+
+    def evaluar(self, entorno):
+        """Evalúa la regla con `entorno` (variable -> número o arreglo)."""
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return eval(self._codigo, {"__builtins__": {}}, entorno)
+
+    def descripcion(self):
+        """Texto de la regla para la interfaz, p. ej. "ÁREA PISO × altura"."""
+        nombres = dict(VARIABLES_REGLA)
+        if self.medida:
+            nombres["M"] = self.medida.replace("MAGICPLAN - ", "")
+        texto = re.sub(r"\b[A-Z_]+\b", lambda m: nombres.get(m.group(0), m.group(0)), self.expresion)
+        return texto.replace("*", " × ")
+
+
+class CatalogoPrecios:
+    """
+    Índice precompilado de la lista de precios unitarios.
+
+    Se construye una sola vez a partir del Excel de costos y se comparte entre
+    todas las vistas, de modo que un rerun no vuelve a recorrer el catálogo.
+
+    Atributos:
+        items, actividades, unidades, areas, formulas, mediciones, expresiones
+            (np.ndarray): Columnas de texto (MEDICION y la columna opcional REGLA).
+        valores (np.ndarray): Valor unitario ofertado (float64, 0 en los títulos).
+        es_categoria (np.ndarray): True en las filas que son títulos de categoría.
+        categoria_fila (np.ndarray): Posición en `categorias` de cada fila (-1 si no tiene).
+        categorias (list): Nombres de las categorías en orden de aparición.
+        indice_categorias (dict): Categoría -> índices de fila de sus actividades.
+        indice_actividades (dict): Nombre de la actividad -> índice de fila.
+        indice_items (dict): Código de ítem (p. ej. "1.3.3") -> índice de fila.
+        reglas (np.ndarray): ReglaCantidad de cada fila (None en los títulos).
+        grupos_reglas (dict): (expresión, medida) -> (ReglaCantidad, filas que la usan).
+        errores_reglas (list): (ítem, expresión, mensaje) de las reglas que no compilaron.
+    """
+
+    COLUMNAS = ("items", "actividades", "unidades", "areas", "formulas", "mediciones", "expresiones", "valores")
+
+    @medido("indice_catalogo")
+    def __init__(self, columnas):
+        """
+        Args:
+            columnas (dict): Arreglos alineados con las claves de `COLUMNAS`.
+        """
+        self.items = np.asarray(columnas["items"], dtype=object)
+        self.actividades = np.asarray(columnas["actividades"], dtype=object)
+        self.unidades = np.asarray(columnas["unidades"], dtype=object)
+        self.areas = np.asarray(columnas["areas"], dtype=object)
+        self.formulas = np.asarray(columnas["formulas"], dtype=object)
+        vacias = np.full(len(self.items), "", dtype=object)
+        self.mediciones = np.asarray(columnas.get("mediciones", vacias), dtype=object)
+        self.expresiones = np.asarray(columnas.get("expresiones", vacias), dtype=object)
+        self.valores = np.asarray(columnas["valores"], dtype=np.float64)
+
+        # Si la actividad está en mayúsculas es el título de una nueva categoría;
+        # las filas siguientes pertenecen a ella hasta el próximo título.
+        self.es_categoria = pd.Series(self.actividades).str.isupper().to_numpy(dtype=bool)
+        self.categoria_fila = (np.cumsum(self.es_categoria) - 1).astype(np.int32)
+        self.categorias = list(self.actividades[self.es_categoria])
+
+        filas_actividad = np.flatnonzero(~self.es_categoria & (self.categoria_fila >= 0))
+        categoria_actividad = self.categoria_fila[filas_actividad]
+        self.indice_categorias = {
+            categoria: filas_actividad[categoria_actividad == posicion]
+            for posicion, categoria in enumerate(self.categorias)
+        }
+
+        self.indice_actividades = {actividad: fila for fila, actividad in enumerate(self.actividades)}
+        self.indice_items = {item: fila for fila, item in enumerate(self.items) if item}
+        self._compilar_reglas()
+
+    def _compilar_reglas(self):
+        """Compila una vez cada regla distinta; las filas que la comparten usan el mismo objeto."""
+        self.reglas = np.full(len(self.items), None, dtype=object)
+        self.errores_reglas = []
+        grupos = {}
+        for fila in np.flatnonzero(~self.es_categoria):
+            area = self.areas[fila]
+            medida = area if area.upper().startswith("MAGICPLAN") else None
+            expresion = expresion_catalogo(area, self.mediciones[fila], self.expresiones[fila])
+            clave = (expresion, medida)
+            if clave not in grupos:
+                try:
+                    grupos[clave] = (ReglaCantidad(expresion, medida), [])
+                except ValueError as e:
+                    # Una regla mal escrita no impide usar el catálogo: se pide la cantidad al usuario
+                    self.errores_reglas.append((self.items[fila], expresion, str(e)))
+                    clave = ("U", None)
+                    grupos.setdefault(clave, (ReglaCantidad("U"), []))
+            grupos[clave][1].append(fila)
+            self.reglas[fila] = grupos[clave][0]
+        self.grupos_reglas = {clave: (regla, np.array(filas)) for clave, (regla, filas) in grupos.items()}
+
+    @classmethod
+    def desde_dataframe(cls, df_costos: pd.DataFrame):
+        """Compila el catálogo a partir de la hoja de costos leída con pandas."""
+        def texto(columna):
+            if columna not in df_costos.columns:
+                return np.full(len(df_costos), "", dtype=object)
+            return df_costos[columna].fillna("").astype(str).to_numpy(dtype=object)
+
+        return cls({
+            "items": texto("Item"),
+            "actividades": texto(COLUMNA_ACTIVIDAD),
+            "unidades": texto("Unidad"),
+            "areas": texto("ÁREA"),
+            "formulas": texto("FORMULA"),
+            "mediciones": texto("MEDICION"),
+            "expresiones": texto("REGLA"),
+            "valores": (
+                pd.to_numeric(df_costos[COLUMNA_VALOR], errors="coerce")
+                .fillna(0.0)
+                .to_numpy(dtype=np.float64)
+            ),
+        })
+
+    def columnas(self):
+        """Columnas base del catálogo (solo tipos de numpy, aptas para una instantánea)."""
+        return {nombre: getattr(self, nombre) for nombre in self.COLUMNAS}
+
+    def __len__(self):
+        return len(self.actividades)
+
+    def buscar(self, clave):
+        """Fila de una actividad por código de ítem o por nombre (None si no existe)."""
+        clave = str(clave).strip()
+        fila = self.indice_items.get(clave, self.indice_actividades.get(clave))
+        if fila is None or self.es_categoria[fila]:
+            return None
+        return fila
+
+    def columna_categorias(self):
+        """Columna 'Categoria' alineada con las filas del catálogo."""
+        nombres = np.array(self.categorias + [None], dtype=object)
+        return nombres[self.categoria_fila]  # -1 apunta al None final
+
+
+class AlmacenCantidades:
+    """
+    Cantidades guardadas por habitación y actividad.
+
+    Es una matriz habitaciones x filas del catálogo indexada por enteros, junto
+    con la selección de cada actividad, las habitaciones activas, la altura de
+    cada habitación y el porcentaje de reducción. Solo se escribe cuando cambia
+    una entrada, y los totales salen de productos matriz-vector contra los
+    valores unitarios. Cada cambio queda en `cambios` para el autoguardado.
+    """
 
-        # 2. Para cada habitación procesada, creamos una columna con la cantidad usada
+    def __init__(self, habitaciones, n_actividades, activas=None):
+        self.habitaciones = list(habitaciones)
+        self.indice = {habitacion: i for i, habitacion in enumerate(self.habitaciones)}
+        # NaN indica una cantidad (o altura) que aún no se ha definido
+        self.cantidades = np.full((len(self.habitaciones), n_actividades), np.nan, dtype=np.float64)
+        self.seleccion = np.zeros((len(self.habitaciones), n_actividades), dtype=bool)
+        if activas is None:
+            self.activas = np.zeros(len(self.habitaciones), dtype=bool)
+        else:
+            self.activas = np.asarray(activas, dtype=bool).copy()
+        self.alturas = np.full(len(self.habitaciones), np.nan, dtype=np.float64)
+        self.porcentaje = 0.0
+        self.version = 0  # Aumenta con cada cambio real
+        self.cambios = []  # (tipo, habitación, fila, valor) pendientes de guardar
+        self.lineas_guardadas = 0  # Líneas ya escritas en el archivo del proyecto
+
+    def _registrar(self, tipo, i, fila, valor):
+        self.version += 1
+        self.cambios.append((tipo, i, fila, valor))
+
+    def fijar_cantidad(self, habitacion, fila, cantidad):
+        i = self.indice[habitacion]
+        cantidad = float(cantidad or 0.0)
+        if self.cantidades[i, fila] != cantidad:
+            self.cantidades[i, fila] = cantidad
+            self._registrar("cantidad", i, fila, cantidad)
+
+    def fijar_seleccion(self, habitacion, fila, seleccionada):
+        i = self.indice[habitacion]
+        if self.seleccion[i, fila] != bool(seleccionada):
+            self.seleccion[i, fila] = bool(seleccionada)
+            self._registrar("seleccion", i, fila, bool(seleccionada))
+
+    def fijar_activa(self, habitacion, activa):
+        i = self.indice[habitacion]
+        if self.activas[i] != bool(activa):
+            self.activas[i] = bool(activa)
+            self._registrar("activa", i, None, bool(activa))
+
+    def fijar_altura(self, habitacion, altura):
+        i = self.indice[habitacion]
+        altura = float(altura or 0.0)
+        if self.alturas[i] != altura:
+            self.alturas[i] = altura
+            self._registrar("altura", i, None, altura)
+
+    def fijar_porcentaje(self, porcentaje):
+        porcentaje = float(porcentaje or 0.0)
+        if self.porcentaje != porcentaje:
+            self.porcentaje = porcentaje
+            self._registrar("porcentaje", None, None, porcentaje)
+
+    def tomar_cambios(self):
+        """Devuelve y vacía la lista de cambios pendientes."""
+        cambios, self.cambios = self.cambios, []
+        return cambios
+
+    def seleccionada(self, habitacion, fila):
+        return bool(self.seleccion[self.indice[habitacion], fila])
+
+    def cantidad(self, habitacion, fila):
+        """Cantidad guardada de una actividad (None si aún no se ha definido)."""
+        cantidad = self.cantidades[self.indice[habitacion], fila]
+        return None if np.isnan(cantidad) else float(cantidad)
+
+    def altura(self, habitacion):
+        """Altura guardada de una habitación (None si aún no se ha definido)."""
+        altura = self.alturas[self.indice[habitacion]]
+        return None if np.isnan(altura) else float(altura)
+
+    def valor(self, habitacion, fila, valor_unitario):
+        """Valor guardado (cantidad x precio unitario) de una actividad."""
+        return (self.cantidad(habitacion, fila) or 0.0) * valor_unitario
+
+    def matriz_efectiva(self):
+        """Cantidades que cuentan: actividad seleccionada en una habitación activa."""
+        cuenta = self.seleccion & self.activas[:, None]
+        return np.where(cuenta, np.nan_to_num(self.cantidades), 0.0)
+
+    def totales_actividad(self):
+        """Cantidad total de cada fila del catálogo sumando todas las habitaciones."""
+        return self.matriz_efectiva().sum(axis=0)
+
+    def subtotales(self, valores):
+        """Costo de cada habitación: producto matriz-vector contra los valores unitarios."""
+        return self.matriz_efectiva() @ valores
+
+
+def entorno_reglas(propiedades, habitaciones, alturas):
+    """Variables de las reglas para `habitaciones`: un vector por medida más la altura H."""
+    posiciones = np.array([propiedades.indice.get(habitacion, -1) for habitacion in habitaciones], dtype=np.int64)
+    encontradas = posiciones >= 0
+    entorno = {"H": np.asarray(alturas, dtype=np.float64)}
+    for medida in propiedades.medidas:
+        columna = np.zeros(len(habitaciones))
+        columna[encontradas] = propiedades.columna(medida)[posiciones[encontradas]]
+        entorno[alias_medida(medida)] = columna
+    return entorno
+
+
+def cantidades_por_defecto(catalogo, propiedades, habitaciones, alturas):
+    """
+    Cantidades sugeridas de todas las actividades en todas las habitaciones.
+
+    Cada regla distinta del catálogo se evalúa una sola vez sobre el vector de
+    habitaciones y su resultado se copia a las filas que la usan.
+
+    Args:
+        catalogo (CatalogoPrecios): Lista de precios con sus reglas.
+        propiedades (PropiedadesHabitaciones): Medidas de la vivienda.
+        habitaciones (list): Habitaciones en el orden de las filas del resultado.
+        alturas (array-like): Altura de cada habitación (NaN si no se conoce).
+
+    Returns:
+        np.ndarray: Matriz habitaciones x filas del catálogo; NaN donde la
+        cantidad la escribe el usuario o falta la altura.
+    """
+    entorno = entorno_reglas(propiedades, habitaciones, alturas)
+    ceros = np.zeros(len(habitaciones))
+    matriz = np.full((len(habitaciones), len(catalogo)), np.nan)
+    for regla, filas in catalogo.grupos_reglas.values():
+        if regla.usa_usuario:
+            continue
+        if regla.medida:
+            entorno["M"] = entorno.get(alias_medida(regla.medida), ceros)
+        # Una cantidad nunca es negativa (NaN se conserva)
+        valores = np.maximum(np.broadcast_to(regla.evaluar(entorno), (len(habitaciones),)), 0.0)
+        matriz[:, filas] = valores[:, None]
+    return matriz
+
+
+def calcular_cantidad(catalogo, propiedades, habitacion, fila, altura=np.nan, usuario=np.nan):
+    """
+    Cantidad de una actividad en una habitación según su regla.
+
+    Args:
+        altura (float, optional): Valor de H.
+        usuario (float, optional): Valor de U (lo que escribió el usuario).
+
+    Returns:
+        float | None: None si falta un valor que la regla necesita.
+    """
+    regla = catalogo.reglas[fila]
+    if regla is None:
+        return None
+    entorno = entorno_reglas(propiedades, [habitacion], [altura])
+    entorno["U"] = np.float64(usuario)
+    if regla.medida:
+        entorno["M"] = entorno.get(alias_medida(regla.medida), np.zeros(1))
+    cantidad = max(float(np.broadcast_to(regla.evaluar(entorno), (1,))[0]), 0.0)
+    return None if np.isnan(cantidad) else cantidad
+
+
+def cotizar_vivienda(catalogo, propiedades, seleccion):
+    """
+    Arma las cantidades de una vivienda a partir de una especificación.
+
+    La especificación asocia habitaciones con actividades (código de ítem o
+    nombre) y su cantidad; una cantidad null usa la regla de la actividad. La
+    clave "*" aplica a todas las habitaciones que la interfaz marca por
+    defecto (las que empiezan por "#").
+
+    Args:
+        catalogo (CatalogoPrecios): Lista de precios.
+        propiedades (PropiedadesHabitaciones): Medidas de la vivienda.
+        seleccion (dict): {habitación | "*": {actividad: cantidad | None}}.
+
+    Returns:
+        tuple: (AlmacenCantidades, lista de avisos).
+    """
+    habitaciones = [habitacion for habitacion in propiedades.keys() if "piso" not in habitacion.lower()]
+    almacen = AlmacenCantidades(habitaciones, len(catalogo))
+    almacen.alturas[:] = propiedades.alturas(habitaciones)
+    avisos = []
+
+    for clave in seleccion:
+        if clave != "*" and clave not in almacen.indice:
+            avisos.append(f"Habitación no encontrada: {clave}")
+
+    # Cantidades sugeridas de toda la vivienda en una sola pasada por las reglas
+    defecto = cantidades_por_defecto(catalogo, propiedades, habitaciones, almacen.alturas)
+
+    for habitacion in habitaciones:
+        actividades = {}
+        if habitacion.startswith("#"):
+            actividades.update(seleccion.get("*", {}))
+        actividades.update(seleccion.get(habitacion, {}))
+        if not actividades:
+            continue
+
+        almacen.fijar_activa(habitacion, True)
+        for actividad, cantidad in actividades.items():
+            fila = catalogo.buscar(actividad)
+            if fila is None:
+                avisos.append(f"Actividad no encontrada: {actividad}")
+                continue
+            if cantidad is None:
+                cantidad = defecto[almacen.indice[habitacion], fila]
+                if np.isnan(cantidad):
+                    avisos.append(f"{habitacion}: '{actividad}' requiere una cantidad")
+                    continue
+            almacen.fijar_seleccion(habitacion, fila, True)
+            almacen.fijar_cantidad(habitacion, fila, cantidad)
+
+    return almacen, avisos
+
+
+RESOLUCION_PRESUPUESTO = 2000  # Pasos en que se divide el tope para la mochila
+COLUMNAS_AJUSTE = ["Habitación", "Item", "Actividad", "Categoría", "Prioridad",
+                   "Cantidad", "Cantidad ajustada", "Costo", "Costo ajustado"]
+
+
+def ajustar_presupuesto(catalogo, almacen, maximo, prioridades=None, reducir=False):
+    """
+    Elige qué actividades conservar para que la vivienda quepa en el tope.
+
+    Cada actividad seleccionada en una habitación activa es una línea; se
+    resuelve una mochila 0/1 por programación dinámica (vectorizada con
+    numpy) que maximiza el costo conservado ponderado por la prioridad de su
+    categoría. Los costos se redondean hacia arriba a pasos de
+    `maximo / RESOLUCION_PRESUPUESTO`, así el resultado nunca supera el tope;
+    el sobrante que deja ese redondeo se vuelve a llenar con las líneas
+    descartadas que aún caben. Las líneas de prioridad 0 no cuentan para la
+    mochila: se descartan primero, pero se conservan si sobra espacio.
+    Con `reducir`, el sobrante se usa para conservar parte de la cantidad de
+    las líneas descartadas, empezando por las de mayor prioridad (las
+    unidades UN se redondean hacia abajo).
+
+    Args:
+        catalogo (CatalogoPrecios): Lista de precios.
+        almacen (AlmacenCantidades): Cantidades de la vivienda.
+        maximo (float): Costo permitido.
+        prioridades (dict, optional): Categoría -> prioridad (por defecto 1).
+        reducir (bool): Permitir reducir cantidades en lugar de solo quitar líneas.
+
+    Returns:
+        pd.DataFrame: Una fila por línea con COLUMNAS_AJUSTE y las posiciones
+        'i' (habitación) y 'fila' (catálogo).
+    """
+    prioridades = prioridades or {}
+    cantidades_matriz = almacen.matriz_efectiva()
+    i, filas = np.nonzero(cantidades_matriz * catalogo.valores > 0)
+    cantidades = cantidades_matriz[i, filas]
+    costos = cantidades * catalogo.valores[filas]
+    categorias = catalogo.columna_categorias()[filas]
+    prioridad = np.array([float(prioridades.get(c, 1.0)) for c in categorias])
+
+    conservar = np.ones(len(costos), dtype=bool)
+    if maximo <= 0:
+        # Reducción del 100 %: no cabe ninguna línea (y la mochila no tendría pasos)
+        conservar[:] = False
+    elif costos.sum() > maximo:
+        conservar[:] = False
+        # 1. Mochila 0/1 sobre pesos discretos: tabla[c] = mejor beneficio con peso <= c
+        paso = maximo / RESOLUCION_PRESUPUESTO
+        pesos = np.maximum(np.ceil(costos / paso - 1e-9), 1).astype(np.int64)
+        beneficios = costos * prioridad
+        tabla = np.zeros(RESOLUCION_PRESUPUESTO + 1)
+        elegido = np.zeros((len(costos), RESOLUCION_PRESUPUESTO + 1), dtype=bool)
+        for k, peso in enumerate(pesos):
+            if peso > RESOLUCION_PRESUPUESTO or beneficios[k] <= 0:
+                continue
+            candidato = tabla[:-peso] + beneficios[k]
+            mejora = candidato > tabla[peso:]
+            elegido[k, peso:] = mejora
+            tabla[peso:] = np.where(mejora, candidato, tabla[peso:])
+
+        # 2. Reconstruir la selección desde el final
+        capacidad = RESOLUCION_PRESUPUESTO
+        for k in range(len(costos) - 1, -1, -1):
+            if elegido[k, capacidad]:
+                conservar[k] = True
+                capacidad -= pesos[k]
+
+        # 3. Rellenar con costos reales el sobrante del redondeo: las descartadas que aún
+        # caben, por beneficio por peso (la prioridad) y luego por costo
+        sobrante = maximo - costos[conservar].sum()
+        for k in np.lexsort((-costos, -prioridad)):
+            if not conservar[k] and costos[k] <= sobrante:
+                conservar[k] = True
+                sobrante -= costos[k]
+
+    ajustadas = np.where(conservar, cantidades, 0.0)
+    if reducir and not conservar.all():
+        # 4. Cantidades parciales con el sobrante, por prioridad y luego por costo
+        sobrante = maximo - (ajustadas * catalogo.valores[filas]).sum()
+        for k in np.lexsort((-costos, -prioridad)):
+            if conservar[k] or sobrante <= 0:
+                continue
+            cantidad = cantidades[k] * min(1.0, sobrante / costos[k])
+            # Hacia abajo: a enteros en UN y a la precisión de los controles en el resto
+            decimales = 1 if catalogo.unidades[filas[k]] in ["UN", "UND"] else 1e4
+            cantidad = np.floor(cantidad * decimales) / decimales
+            ajustadas[k] = cantidad
+            sobrante -= cantidad * catalogo.valores[filas[k]]
+
+    return pd.DataFrame({
+        "Habitación": np.asarray(almacen.habitaciones, dtype=object)[i],
+        "Item": catalogo.items[filas],
+        "Actividad": catalogo.actividades[filas],
+        "Categoría": categorias,
+        "Prioridad": prioridad,
+        "Cantidad": cantidades,
+        "Cantidad ajustada": ajustadas,
+        "Costo": costos,
+        "Costo ajustado": ajustadas * catalogo.valores[filas],
+        "i": i,
+        "fila": filas,
+    }, columns=COLUMNAS_AJUSTE + ["i", "fila"])
+
+
+def aplicar_ajuste(almacen, catalogo, df_ajuste):
+    """
+    Lleva el ajuste al almacén: quita las líneas descartadas y fija las reducidas.
+
+    Las cantidades de las líneas quitadas se conservan, así basta marcarlas
+    de nuevo para recuperarlas.
+    """
+    cambios = df_ajuste[df_ajuste["Cantidad ajustada"] != df_ajuste["Cantidad"]]
+    for i, fila, cantidad in zip(cambios["i"], cambios["fila"], cambios["Cantidad ajustada"]):
+        habitacion = almacen.habitaciones[i]
+        if cantidad > 0:
+            almacen.fijar_cantidad(habitacion, fila, cantidad)
+        else:
+            almacen.fijar_seleccion(habitacion, fila, False)
+        olvidar_controles(habitacion, catalogo.actividades[fila])
+    return len(cambios)
+
+
+def olvidar_controles(habitacion, actividad):
+    """Borra el estado de los controles de una actividad para que tomen el valor del almacén."""
+    for key in (f"check_{habitacion}_{actividad}", f"cantidad_{habitacion}_{actividad}",
+                f"cantidad_{habitacion}_{actividad}_aux"):
+        st.session_state.pop(key, None)
+
+
+def panel_ajuste(catalogo, almacen, max_total):
+    """Propone y aplica un ajuste automático cuando la vivienda supera el tope."""
+    with st.expander("⚖️ Ajustar al presupuesto", expanded=True):
+        st.write("Calcula qué actividades conservar para quedar dentro del costo permitido. "
+                 "Las categorías con mayor prioridad se conservan primero (0 = descartar primero).")
+        elegidas = np.unique(catalogo.categoria_fila[(almacen.matriz_efectiva() > 0).any(axis=0)])
+        categorias = [catalogo.categorias[c] for c in elegidas if c >= 0]
+        df_prioridades = st.data_editor(
+            pd.DataFrame({"Categoría": categorias, "Prioridad": 1}),
+            column_config={"Prioridad": st.column_config.NumberColumn(min_value=0, max_value=10, step=1)},
+            disabled=["Categoría"], hide_index=True, key="prioridades_ajuste"
+        )
+        reducir = st.checkbox("Permitir reducir cantidades (no solo quitar actividades)", key="ajuste_reducir")
+
+        if st.button("Calcular ajuste"):
+            prioridades = dict(zip(df_prioridades["Categoría"], df_prioridades["Prioridad"]))
+            st.session_state["ajuste"] = {
+                "version": almacen.version,
+                "tabla": ajustar_presupuesto(catalogo, almacen, max_total, prioridades, reducir),
+            }
+
+        ajuste = st.session_state.get("ajuste")
+        if not ajuste or ajuste["version"] != almacen.version:
+            return  # Sin propuesta, o las cantidades cambiaron desde que se calculó
+        tabla = ajuste["tabla"]
+        cambios = tabla[tabla["Cantidad ajustada"] != tabla["Cantidad"]]
+        st.markdown(f"**Total ajustado: ${tabla['Costo ajustado'].sum():,.2f}** "
+                    f"({(cambios['Cantidad ajustada'] == 0).sum()} actividades quitadas, "
+                    f"{(cambios['Cantidad ajustada'] > 0).sum()} reducidas)")
+        st.dataframe(cambios[COLUMNAS_AJUSTE].round(2), hide_index=True)
+        if st.button("Aplicar ajuste"):
+            aplicar_ajuste(almacen, catalogo, tabla)
+            st.session_state.pop("ajuste", None)
+            st.rerun()
+
+
+def obtener_almacen(habitaciones, catalogo):
+    """
+    Devuelve el almacén de cantidades de la sesión.
+
+    Se crea de nuevo solo cuando cambian las habitaciones (otro CSV) o el catálogo.
+    Al crearlo se restaura, si existe, el proyecto guardado de la vivienda.
+    """
+    almacen = st.session_state.get("almacen")
+    if (
+        almacen is None
+        or almacen.habitaciones != list(habitaciones)
+        or almacen.cantidades.shape[1] != len(catalogo)
+    ):
+        # Por defecto se activan las habitaciones marcadas con "#"
+        almacen = AlmacenCantidades(habitaciones, len(catalogo),
+                                    activas=[habitacion.startswith("#") for habitacion in habitaciones])
+        st.session_state.pop("ajuste", None)  # Sus posiciones i/fila son de las habitaciones del almacén anterior
+        # La altura del techo viene del CSV; solo se pide si MagicPlan no la trae
         if "resultados_csv" in st.session_state:
-            habitaciones_procesadas = [
-                habitacion
-                for habitacion in st.session_state["resultados_csv"].keys()
-                if "piso" not in habitacion.lower()
-            ]
-
-            for habitacion in habitaciones_procesadas:
-                df_intermedio[habitacion] = 0.0
-                for i, row in df_intermedio.iterrows():
-                    actividad = row["ACTIVIDAD DE OBRA - LISTA DE PRECIOS UNITARIOS"]
-                    cantidad_key = f"cantidad_{habitacion}_{actividad}"
-                    if cantidad_key in st.session_state:
-                        df_intermedio.at[i, habitacion] = st.session_state[cantidad_key]
-
-            # 3. Sumar las columnas de habitaciones para obtener 'Total actividad'
-            df_intermedio["Total actividad"] = df_intermedio[habitaciones_procesadas].sum(axis=1)
-
-            # 4. Costo total
-            df_intermedio["Costo total"] = (
-                df_intermedio["Total actividad"] *
-                df_intermedio["Valor Unitario ofertado (**)"]
+            almacen.alturas[:] = st.session_state["resultados_csv"].alturas(habitaciones)
+        st.session_state["almacen"] = almacen
+
+        huella_csv = st.session_state.get("huella_csv")
+        ruta = ruta_proyecto(huella_csv, propietario_proyecto()) if huella_csv else None
+        if ruta and os.path.exists(ruta):
+            eventos = cargar_proyecto(ruta, almacen, catalogo)
+            st.session_state["proyecto_restaurado"] = eventos
+            if almacen.porcentaje != st.session_state.get("max_porcentaje", 0.0):
+                # El porcentaje es un widget ya dibujado: se aplica en el próximo rerun
+                st.session_state["porcentaje_pendiente"] = almacen.porcentaje
+                st.rerun()
+    return almacen
+
+
+CARPETA_PROYECTOS = "proyectos"
+VERSION_PROYECTO = 1
+MAX_LINEAS_PROYECTO = 5000  # Al superarlas, el archivo se compacta
+
+
+def propietario_proyecto():
+    """
+    Identificador de quien trabaja en la sesión, guardado en la URL (?proyecto=...).
+
+    La carpeta de proyectos es compartida por todo el servidor: sin este
+    identificador dos personas que abren la misma vivienda escribirían en el
+    mismo archivo. Al estar en la URL sobrevive a recargas y reconexiones, y
+    solo se comparte si se comparte el enlace.
+    """
+    propietario = st.query_params.get("proyecto", "")
+    if not re.fullmatch(r"[0-9a-f]{16}", propietario):
+        propietario = secrets.token_hex(8)
+        st.query_params["proyecto"] = propietario
+    return propietario
+
+
+def ruta_proyecto(huella_csv, propietario):
+    """Archivo del proyecto de una vivienda (contenido de su CSV) para un propietario."""
+    return os.path.join(CARPETA_PROYECTOS, f"{huella_csv[:16]}_{propietario}.jsonl")
+
+
+@st.cache_resource
+def candado_proyectos():
+    """Serializa las escrituras de proyectos entre sesiones (p. ej. dos pestañas del mismo enlace)."""
+    return threading.Lock()
+
+
+def _evento_json(cambio, almacen, catalogo):
+    tipo, i, fila, valor = cambio
+    evento = {"t": tipo}
+    if i is not None:
+        evento["h"] = almacen.habitaciones[i]
+    if fila is not None:
+        evento["a"] = catalogo.items[fila] or catalogo.actividades[fila]
+    evento["v"] = valor
+    return json.dumps(evento, ensure_ascii=False)
+
+
+def estado_proyecto(almacen, catalogo, encabezado):
+    """
+    Líneas JSON que reproducen el estado completo del almacén.
+
+    Args:
+        almacen (AlmacenCantidades): Estado a guardar.
+        catalogo (CatalogoPrecios): Para identificar las actividades por ítem.
+        encabezado (dict): Datos de la vivienda para la primera línea.
+
+    Returns:
+        list: Líneas del archivo del proyecto (sin salto de línea).
+    """
+    cambios = [("porcentaje", None, None, almacen.porcentaje)]
+    cambios += [("activa", i, None, bool(activa)) for i, activa in enumerate(almacen.activas)]
+    cambios += [("altura", i, None, float(almacen.alturas[i])) for i in np.flatnonzero(~np.isnan(almacen.alturas))]
+    cambios += [("seleccion", i, f, True) for i, f in np.argwhere(almacen.seleccion)]
+    cambios += [("cantidad", i, f, float(almacen.cantidades[i, f])) for i, f in np.argwhere(~np.isnan(almacen.cantidades))]
+    cabecera = json.dumps({"t": "proyecto", "version": VERSION_PROYECTO, **encabezado}, ensure_ascii=False)
+    return [cabecera] + [_evento_json(cambio, almacen, catalogo) for cambio in cambios]
+
+
+def guardar_proyecto(ruta, almacen, catalogo, encabezado):
+    """
+    Autoguardado incremental: agrega al archivo solo los cambios pendientes.
+
+    El archivo es JSONL de solo anexado. Se reescribe completo (compactado)
+    cuando aún no existe o cuando supera MAX_LINEAS_PROYECTO líneas.
+    """
+    cambios = almacen.tomar_cambios()
+    if not cambios:
+        return
+    try:
+        with candado_proyectos():
+            _escribir_proyecto(ruta, almacen, catalogo, encabezado, cambios)
+    except OSError as e:
+        almacen.cambios[:0] = cambios  # Se reintenta en el próximo rerun
+        st.sidebar.error(f"No se pudo guardar el proyecto: {str(e)}")
+
+
+def _escribir_proyecto(ruta, almacen, catalogo, encabezado, cambios):
+    existe = os.path.exists(ruta)
+    lineas_previas = almacen.lineas_guardadas if existe else 0
+    if not existe or lineas_previas + len(cambios) > MAX_LINEAS_PROYECTO:
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        lineas = estado_proyecto(almacen, catalogo, encabezado)
+        temporal = f"{ruta}.{os.getpid()}.tmp"
+        with open(temporal, "w", encoding="utf-8") as archivo:
+            archivo.write("\n".join(lineas) + "\n")
+        os.replace(temporal, ruta)
+        almacen.lineas_guardadas = len(lineas)
+    else:
+        with open(ruta, "a", encoding="utf-8") as archivo:
+            archivo.write("\n".join(_evento_json(cambio, almacen, catalogo) for cambio in cambios) + "\n")
+        almacen.lineas_guardadas = lineas_previas + len(cambios)
+
+
+def cargar_proyecto(ruta, almacen, catalogo):
+    """
+    Restaura un proyecto guardado aplicando todos sus cambios de una sola vez.
+
+    Los eventos se reducen primero a su último valor y luego se escriben en
+    bloque sobre las matrices del almacén. Las líneas dañadas (p. ej. por un
+    corte a mitad de escritura) y las habitaciones o actividades que ya no
+    existen se ignoran.
+
+    Returns:
+        int: Número de eventos leídos.
+    """
+    cantidades, seleccion, activas, alturas = {}, {}, {}, {}
+    eventos = 0
+    with open(ruta, encoding="utf-8") as archivo:
+        for linea in archivo:
+            try:
+                evento = json.loads(linea)
+            except ValueError:
+                continue
+            tipo = evento.get("t")
+            if tipo == "porcentaje":
+                almacen.porcentaje = float(evento["v"] or 0.0)
+                eventos += 1
+                continue
+            i = almacen.indice.get(evento.get("h"))
+            if i is None:
+                continue
+            eventos += 1
+            if tipo == "activa":
+                activas[i] = bool(evento["v"])
+            elif tipo == "altura":
+                alturas[i] = float(evento["v"])
+            elif tipo in ("cantidad", "seleccion"):
+                fila = catalogo.buscar(evento.get("a", ""))
+                if fila is None:
+                    continue
+                destino = cantidades if tipo == "cantidad" else seleccion
+                destino[(i, fila)] = evento["v"]
+
+    if activas:
+        almacen.activas[list(activas)] = list(activas.values())
+    if alturas:
+        almacen.alturas[list(alturas)] = list(alturas.values())
+    for destino, matriz in ((cantidades, almacen.cantidades), (seleccion, almacen.seleccion)):
+        if destino:
+            posiciones = np.array(list(destino), dtype=np.int64)
+            matriz[posiciones[:, 0], posiciones[:, 1]] = list(destino.values())
+
+    almacen.tomar_cambios()
+    almacen.lineas_guardadas = eventos + 1
+    return eventos
+
+
+def encabezado_proyecto():
+    return {
+        "vivienda": st.session_state.get("nombre_vivienda"),
+        "huella_csv": st.session_state.get("huella_csv"),
+    }
+
+
+def panel_proyecto(almacen, catalogo):
+    """Autoguardado del proyecto de la vivienda y opciones en la barra lateral."""
+    huella_csv = st.session_state.get("huella_csv")
+    if not huella_csv:
+        return
+    ruta = ruta_proyecto(huella_csv, propietario_proyecto())
+
+    almacen.fijar_porcentaje(st.session_state.get("max_porcentaje", 0.0))
+    guardar_proyecto(ruta, almacen, catalogo, encabezado_proyecto())
+
+    st.sidebar.subheader("Proyecto")
+    if st.session_state.get("proyecto_restaurado"):
+        st.sidebar.info(f"Proyecto restaurado ({st.session_state['proyecto_restaurado']} cambios guardados).")
+    st.sidebar.caption("💾 Los cambios se guardan automáticamente.")
+    st.sidebar.download_button(
+        label="Descargar proyecto",
+        data="\n".join(estado_proyecto(almacen, catalogo, encabezado_proyecto())) + "\n",
+        file_name=f"Proyecto_{st.session_state.get('nombre_vivienda') or 'Vivienda'}.jsonl",
+        mime="application/jsonl"
+    )
+    if st.sidebar.button("Empezar de cero"):
+        with candado_proyectos():
+            if os.path.exists(ruta):
+                os.remove(ruta)
+        olvidar_vivienda()
+        st.rerun()
+
+
+def olvidar_vivienda():
+    """
+    Borra de la sesión las cantidades y los widgets de la vivienda actual.
+
+    Los widgets guardan su valor en session_state con claves por habitación y
+    actividad; si quedaran, al reconstruir el almacén se volverían a escribir
+    en él y en el proyecto de la vivienda siguiente.
+    """
+    for key in list(st.session_state.keys()):
+        if key.startswith(("check_", "cantidad_", "habitacion_", "button_")):
+            del st.session_state[key]
+    st.session_state.pop("almacen", None)
+    st.session_state.pop("proyecto_restaurado", None)
+
+
+def almacen_desde_proyecto(ruta, catalogo):
+    """
+    Reconstruye el almacén de un proyecto guardado sin su CSV.
+
+    Las habitaciones se toman de los propios eventos del archivo.
+
+    Returns:
+        tuple: (encabezado del proyecto, AlmacenCantidades).
+    """
+    encabezado, habitaciones = {}, {}
+    with open(ruta, encoding="utf-8") as archivo:
+        for linea in archivo:
+            try:
+                evento = json.loads(linea)
+            except ValueError:
+                continue
+            if evento.get("t") == "proyecto":
+                encabezado = evento
+            elif "h" in evento:
+                habitaciones.setdefault(evento["h"], None)
+    almacen = AlmacenCantidades(list(habitaciones), len(catalogo))
+    cargar_proyecto(ruta, almacen, catalogo)
+    return encabezado, almacen
+
+
+class CarteraViviendas:
+    """
+    Varias viviendas en un solo almacén por columnas.
+
+    Cada actividad con cantidad en una habitación activa de cualquier vivienda
+    es una fila de `lineas` (vivienda, habitación, fila del catálogo, cantidad
+    y costo). Los totales y la demanda por ítem son agrupaciones vectorizadas
+    (np.bincount) sobre esas columnas, así filtrar u ordenar no vuelve a
+    cotizar ninguna vivienda.
+
+    Atributos:
+        viviendas (pd.DataFrame): Una fila por vivienda: Vivienda, Origen, Habitaciones, Porcentaje, Máximo.
+        lineas (pd.DataFrame): vivienda (código), habitacion, fila, cantidad, costo.
+    """
+
+    def __init__(self, catalogo, viviendas, lineas):
+        self.catalogo = catalogo
+        self.viviendas = viviendas
+        self.lineas = lineas
+
+    @classmethod
+    def desde_almacenes(cls, catalogo, almacenes):
+        """
+        Args:
+            almacenes (iterable): Tuplas (nombre, origen, AlmacenCantidades).
+        """
+        viviendas, codigos, habitaciones, filas, cantidades = [], [], [], [], []
+        for codigo, (nombre, origen, almacen) in enumerate(almacenes):
+            matriz = almacen.matriz_efectiva()
+            i, f = np.nonzero(matriz)
+            viviendas.append((nombre, origen, int(almacen.activas.sum()), almacen.porcentaje,
+                              calcular_max_costo(almacen.porcentaje)))
+            codigos.append(np.full(len(f), codigo, dtype=np.int32))
+            habitaciones.append(np.asarray(almacen.habitaciones, dtype=object)[i])
+            filas.append(f.astype(np.int32))
+            cantidades.append(matriz[i, f])
+
+        filas = np.concatenate(filas) if filas else np.zeros(0, dtype=np.int32)
+        cantidades = np.concatenate(cantidades) if cantidades else np.zeros(0)
+        lineas = pd.DataFrame({
+            "vivienda": np.concatenate(codigos) if codigos else np.zeros(0, dtype=np.int32),
+            "habitacion": pd.Categorical(np.concatenate(habitaciones) if habitaciones else []),
+            "fila": filas,
+            "cantidad": cantidades,
+            "costo": cantidades * catalogo.valores[filas],
+        })
+        df_viviendas = pd.DataFrame(viviendas, columns=["Vivienda", "Origen", "Habitaciones", "Porcentaje", "Máximo"])
+        return cls(catalogo, df_viviendas, lineas)
+
+    def __len__(self):
+        return len(self.viviendas)
+
+    def totales(self):
+        """Total de cada vivienda frente a su tope."""
+        n = len(self.viviendas)
+        codigos = self.lineas["vivienda"].to_numpy()
+        df = self.viviendas.copy()
+        df["Líneas"] = np.bincount(codigos, minlength=n)
+        df["Total"] = np.bincount(codigos, weights=self.lineas["costo"].to_numpy(), minlength=n)
+        df["Diferencia"] = df["Máximo"] - df["Total"]
+        df["Estado"] = np.where(df["Total"] > df["Máximo"], "Excede", "Dentro del tope")
+        return df
+
+    def demanda(self, viviendas=None, categorias=None):
+        """
+        Cantidades y costos agregados por ítem del catálogo para compras.
+
+        Args:
+            viviendas (array-like, optional): Posiciones de las viviendas a incluir.
+            categorias (list, optional): Categorías a incluir.
+
+        Returns:
+            pd.DataFrame: Item, Categoría, Actividad, Unidad, Cantidad, Costo y Viviendas por ítem.
+        """
+        codigos = self.lineas["vivienda"].to_numpy()
+        filas = self.lineas["fila"].to_numpy()
+        incluir = np.ones(len(filas), dtype=bool)
+        if viviendas is not None:
+            incluir &= np.isin(codigos, viviendas)
+        columna_categorias = self.catalogo.columna_categorias()
+        if categorias:
+            incluir &= np.isin(columna_categorias[filas], categorias)
+
+        n = len(self.catalogo)
+        cantidad = np.bincount(filas[incluir], weights=self.lineas["cantidad"].to_numpy()[incluir], minlength=n)
+        costo = np.bincount(filas[incluir], weights=self.lineas["costo"].to_numpy()[incluir], minlength=n)
+        # Viviendas distintas por ítem: pares (vivienda, fila) únicos
+        pares = np.unique(codigos[incluir].astype(np.int64) * n + filas[incluir])
+        viviendas_item = np.bincount(pares % n, minlength=n)
+
+        usadas = np.flatnonzero(cantidad > 0)
+        return pd.DataFrame({
+            "Item": self.catalogo.items[usadas],
+            "Categoría": columna_categorias[usadas],
+            "Actividad": self.catalogo.actividades[usadas],
+            "Unidad": self.catalogo.unidades[usadas],
+            "Cantidad": cantidad[usadas],
+            "Costo": costo[usadas],
+            "Viviendas": viviendas_item[usadas],
+        })
+
+
+def cartera_desde_proyectos(catalogo, carpeta=CARPETA_PROYECTOS):
+    """Cartera con todos los proyectos guardados en `carpeta`."""
+    almacenes = []
+    for nombre in sorted(os.listdir(carpeta)) if os.path.isdir(carpeta) else []:
+        if not nombre.endswith(".jsonl"):
+            continue
+        encabezado, almacen = almacen_desde_proyecto(os.path.join(carpeta, nombre), catalogo)
+        almacenes.append((encabezado.get("vivienda") or os.path.splitext(nombre)[0], nombre, almacen))
+    return CarteraViviendas.desde_almacenes(catalogo, almacenes)
+
+
+def cartera_desde_csv(catalogo, archivos, especificacion):
+    """
+    Cartera cotizando cada CSV de MagicPlan con una especificación (ver cotizar_lote.py).
+
+    Args:
+        archivos (iterable): Pares (nombre, bytes del CSV).
+        especificacion (dict): {"porcentaje": ..., "habitaciones": {...}}.
+    """
+    almacenes = []
+    for nombre, datos in archivos:
+        _, codigo, _, propiedades = ingerir_csv(datos)
+        if codigo != 200:
+            continue
+        almacen, _ = cotizar_vivienda(catalogo, propiedades, especificacion.get("habitaciones", {}))
+        almacen.porcentaje = float(especificacion.get("porcentaje", 0.0))
+        almacenes.append((os.path.splitext(nombre)[0], nombre, almacen))
+    return CarteraViviendas.desde_almacenes(catalogo, almacenes)
+
+
+def vista_cartera(catalogo):
+    """Modo cartera: totales por vivienda y demanda agregada del catálogo."""
+    st.title("Cartera de viviendas")
+    origen = st.radio("Origen de las viviendas", ["Proyectos guardados", "Archivos CSV"], horizontal=True)
+
+    # La cartera solo se vuelve a armar cuando cambian sus archivos de origen
+    if origen == "Proyectos guardados":
+        nombres = sorted(os.listdir(CARPETA_PROYECTOS)) if os.path.isdir(CARPETA_PROYECTOS) else []
+        clave = ("proyectos",) + tuple(
+            (nombre, os.stat(os.path.join(CARPETA_PROYECTOS, nombre)).st_mtime_ns)
+            for nombre in nombres if nombre.endswith(".jsonl")
+        )
+        construir = lambda: cartera_desde_proyectos(catalogo)
+    else:
+        archivos = st.file_uploader("CSV de MagicPlan", type=["csv"], accept_multiple_files=True, key="cartera_csv")
+        archivo_especificacion = st.file_uploader("Especificación de actividades (JSON)", type=["json"],
+                                                  key="cartera_especificacion")
+        if not archivos or not archivo_especificacion:
+            st.info("Suba los CSV de las viviendas y la especificación de actividades (mismo formato que cotizar_lote.py).")
+            return
+        try:
+            especificacion = json.loads(archivo_especificacion.getvalue())
+        except ValueError as e:
+            st.error(f"La especificación no es un JSON válido: {str(e)}")
+            return
+        clave = ("csv", archivo_especificacion.file_id) + tuple(archivo.file_id for archivo in archivos)
+        construir = lambda: cartera_desde_csv(catalogo, [(a.name, a.getvalue()) for a in archivos], especificacion)
+
+    guardada = st.session_state.get("cartera")
+    if guardada is None or guardada["clave"] != clave:
+        with st.spinner("Cargando viviendas..."):
+            guardada = {"clave": clave, "cartera": construir()}
+        st.session_state["cartera"] = guardada
+    cartera = guardada["cartera"]
+    if not len(cartera):
+        st.warning("No hay viviendas para mostrar.")
+        return
+
+    # 1. Totales por vivienda frente a su tope
+    totales = cartera.totales()
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Viviendas", len(totales))
+    col2.metric("Dentro del tope", int((totales["Estado"] == "Dentro del tope").sum()))
+    col3.metric("Costo total", f"${totales['Total'].sum():,.0f}")
+
+    st.subheader("Totales por vivienda")
+    col_estado, col_texto, col_orden = st.columns(3)
+    estados = col_estado.multiselect("Estado", ["Dentro del tope", "Excede"], key="cartera_estado")
+    texto = col_texto.text_input("Buscar vivienda", key="cartera_buscar")
+    orden = col_orden.selectbox("Ordenar por", ["Total", "Diferencia", "Vivienda", "Líneas"], key="cartera_orden")
+    filtro = np.ones(len(totales), dtype=bool)
+    if estados:
+        filtro &= totales["Estado"].isin(estados).to_numpy()
+    if texto:
+        filtro &= totales["Vivienda"].str.contains(texto, case=False, regex=False).to_numpy()
+    visibles = totales[filtro].sort_values(orden, ascending=orden in ("Vivienda", "Diferencia"))
+    st.dataframe(visibles.round(2), hide_index=True)
+
+    # 2. Demanda agregada por ítem de las viviendas filtradas
+    st.subheader("Demanda agregada por ítem")
+    categorias = st.multiselect("Categorías", catalogo.categorias, key="cartera_categorias")
+    demanda = cartera.demanda(np.flatnonzero(filtro), categorias).sort_values("Costo", ascending=False)
+    st.dataframe(demanda.round(2), hide_index=True)
+    st.download_button(
+        label="Descargar demanda (CSV)",
+        data=demanda.to_csv(index=False).encode("utf-8-sig"),
+        file_name="Demanda_cartera.csv",
+        mime="text/csv"
+    )
+
+
+CARPETA_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")  # Junto al script, no en el directorio de trabajo
+VERSION_INSTANTANEA = 2
+
+
+@medido("carga_catalogo")
+def cargar_catalogo(ruta_excel=None):
+    """
+    Carga el catálogo desde una instantánea binaria precompilada.
+
+    La instantánea (columnas del catálogo en pickle) se vuelve a generar desde
+    el Excel solo cuando cambia el archivo: primero se compara la fecha de
+    modificación y el tamaño; si difieren, se compara el hash del contenido.
+
+    Args:
+        ruta_excel (str, optional): Excel de costos; por defecto RUTA_ARCHIVO_COSTOS.
+
+    Returns:
+        CatalogoPrecios: Catálogo compilado.
+    """
+    ruta_excel = ruta_excel or RUTA_ARCHIVO_COSTOS
+    estado = os.stat(ruta_excel)
+    nombre = os.path.splitext(os.path.basename(ruta_excel))[0]
+    ruta_instantanea = os.path.join(CARPETA_CACHE, f"catalogo_{nombre}.pkl")
+
+    instantanea, huella = None, None
+    try:
+        with open(ruta_instantanea, "rb") as archivo:
+            instantanea = pickle.load(archivo)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+        pass
+
+    if instantanea and instantanea.get("version") == VERSION_INSTANTANEA:
+        if (instantanea["mtime_ns"], instantanea["tamano"]) == (estado.st_mtime_ns, estado.st_size):
+            return CatalogoPrecios(instantanea["columnas"])
+        huella = _huella_archivo(ruta_excel)
+        if huella == instantanea["huella"]:
+            instantanea.update(mtime_ns=estado.st_mtime_ns, tamano=estado.st_size)
+            _guardar_instantanea(ruta_instantanea, instantanea)
+            return CatalogoPrecios(instantanea["columnas"])
+
+    catalogo = CatalogoPrecios.desde_dataframe(pd.read_excel(ruta_excel, sheet_name=HOJA_COSTOS))
+    _guardar_instantanea(ruta_instantanea, {
+        "version": VERSION_INSTANTANEA,
+        "mtime_ns": estado.st_mtime_ns,
+        "tamano": estado.st_size,
+        "huella": huella or _huella_archivo(ruta_excel),
+        "columnas": catalogo.columnas(),
+    })
+    return catalogo
+
+
+def _huella_archivo(ruta):
+    with open(ruta, "rb") as archivo:
+        return huella_bytes(archivo.read())
+
+
+def _guardar_instantanea(ruta, contenido):
+    """Escribe la instantánea de forma atómica; si no se puede escribir, se omite."""
+    try:
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        temporal = f"{ruta}.{os.getpid()}.tmp"
+        with open(temporal, "wb") as archivo:
+            pickle.dump(contenido, archivo, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporal, ruta)
+    except OSError:
+        pass
+
+
+@st.cache_resource
+def obtener_catalogo():
+    """Catálogo compartido por todas las sesiones (solo lectura)."""
+    return cargar_catalogo()
+
+
+@medido("agregacion_resumen")
+def construir_resumen(catalogo, almacen):
+    """
+    Resumen de actividades con sus cantidades totales y costos.
+
+    Args:
+        catalogo (CatalogoPrecios): Lista de precios.
+        almacen (AlmacenCantidades): Cantidades de la vivienda.
+
+    Returns:
+        pd.DataFrame: Una fila por fila del catálogo con 'Total actividad' y 'Costo total'.
+    """
+    # 'Total actividad': suma de las cantidades de todas las habitaciones activas
+    total_actividad = almacen.totales_actividad()
+
+    return pd.DataFrame({
+        "Item": catalogo.items,
+        # Columna 'Categoria' tomada del índice precompilado
+        "Categoria": catalogo.columna_categorias(),
+        "ACTIVIDAD DE OBRA - LISTA DE PRECIOS UNITARIOS": catalogo.actividades,
+        "Unidad": catalogo.unidades,
+        "Valor Unitario ofertado (**)": catalogo.valores,
+        "Total actividad": total_actividad,
+        "Costo total": total_actividad * catalogo.valores,
+    })
+
+
+def obtener_tabla_habitaciones():
+    """Resumen de actividades de la sesión actual (None si faltan datos)."""
+    if "catalogo" in st.session_state and "almacen" in st.session_state:
+        return construir_resumen(st.session_state["catalogo"], st.session_state["almacen"])
+    return None
+
+
+def huella_resumen(df_resumen):
+    """
+    Huella de contenido del resumen: actividades activas, cantidades y precios.
+
+    Dos resúmenes con la misma huella producen el mismo reporte.
+    """
+    activas = df_resumen[df_resumen["Total actividad"] > 0]
+    valores_hash = pd.util.hash_pandas_object(activas, index=True).to_numpy()
+    return hashlib.sha256(valores_hash.tobytes()).hexdigest()
+
+
+MAX_TRABAJOS_REPORTE = 2  # Reportes que se construyen a la vez en el servidor
+RETENCION_REPORTES = 600  # Segundos que se guarda un reporte terminado que nadie recogió
+
+
+class TrabajoReporte:
+    """Construcción de un reporte en segundo plano, identificada por la huella del resumen."""
+
+    def __init__(self, huella):
+        self.huella = huella
+        self.progreso = 0.0
+        self.cancelado = threading.Event()
+        self.futuro = None
+        self.interesados = 1  # Sesiones que esperan este reporte
+        self.terminado = None  # Momento en que terminó (time.time())
+
+    def listo(self):
+        return self.futuro.done()
+
+    def fijar_progreso(self, fraccion):
+        self.progreso = fraccion
+
+
+class PoolReportes:
+    """
+    Grupo acotado de hilos que construye los reportes fuera del hilo del script.
+
+    Se comparte entre todas las sesiones: dos sesiones que piden un reporte
+    con la misma huella reciben el mismo trabajo. Un trabajo se cancela
+    cuando ninguna sesión lo espera ya.
+    """
+
+    def __init__(self, max_trabajadores):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self._executor = ThreadPoolExecutor(max_workers=max_trabajadores, thread_name_prefix="reporte")
+        self._trabajos = {}
+        self._lock = threading.Lock()
+
+    def solicitar(self, huella, df_resumen, plantilla):
+        """Trabajo del reporte con `huella`: el que ya existe o uno nuevo."""
+        with self._lock:
+            self._purgar()
+            trabajo = self._trabajos.get(huella)
+            if trabajo is not None and not trabajo.cancelado.is_set():
+                trabajo.interesados += 1
+                return trabajo
+            trabajo = TrabajoReporte(huella)
+            # Se encola antes de soltar el candado: quien lo encuentre en _trabajos ya tiene su futuro
+            trabajo.futuro = self._executor.submit(
+                construir_reporte, df_resumen, plantilla, trabajo.fijar_progreso, trabajo.cancelado
             )
+            trabajo.futuro.add_done_callback(lambda _: setattr(trabajo, "terminado", time.time()))
+            self._trabajos[huella] = trabajo
+        return trabajo
+
+    def soltar(self, trabajo):
+        """La sesión ya no espera el trabajo; si nadie más lo hace, se cancela y se olvida."""
+        with self._lock:
+            trabajo.interesados -= 1
+            if trabajo.interesados > 0:
+                return
+            trabajo.cancelado.set()
+            trabajo.futuro.cancel()  # Si aún no empezó, no llega a ejecutarse
+            if self._trabajos.get(trabajo.huella) is trabajo:
+                del self._trabajos[trabajo.huella]
+
+    def _purgar(self):
+        # Trabajos terminados de sesiones que se cerraron sin recogerlos
+        limite = time.time() - RETENCION_REPORTES
+        for huella, trabajo in list(self._trabajos.items()):
+            if trabajo.terminado is not None and trabajo.terminado < limite:
+                del self._trabajos[huella]
+
+
+def construir_reporte(df_resumen, plantilla, progreso=None, cancelado=None):
+    """
+    Tarea del hilo de trabajo: construye el reporte sin tocar la interfaz.
+
+    En el hilo no hay contexto de Streamlit ni perfilador de la sesión (el
+    executor no copia las contextvars), así que el aviso y la duración se
+    devuelven para que los registre la sesión que recoge el reporte.
+
+    Returns:
+        tuple: (bytes del reporte, aviso o None, segundos de escritura).
+    """
+    aviso = None
+    if not (df_resumen["Total actividad"] > 0).any():
+        aviso = "No hay actividades con valor > 0. El Excel quedará vacío."
+    inicio = time.perf_counter()
+    datos = export_to_excel(df_resumen, plantilla, progreso, cancelado)
+    return datos, aviso, time.perf_counter() - inicio
+
+
+@st.cache_resource
+def obtener_pool_reportes():
+    return PoolReportes(MAX_TRABAJOS_REPORTE)
+
+
+def reporte_bajo_demanda(df_resumen, generar):
+    """
+    Devuelve los bytes del reporte solo cuando están al día con el resumen.
+
+    El libro se construye en segundo plano (PoolReportes) únicamente si
+    `generar` es True; mientras tanto la sesión guarda el trabajo pendiente y
+    se puede seguir editando. Si el resumen cambia, el trabajo pendiente (ya
+    obsoleto) se cancela y los bytes anteriores se descartan.
+
+    Args:
+        df_resumen (pd.DataFrame): Resumen de actividades de obtener_tabla_habitaciones().
+        generar (bool): El usuario pidió el reporte en este rerun.
+
+    Returns:
+        bytes | None: Reporte vigente, o None si aún no está listo.
+
+    Raises:
+        Exception: El error de la construcción, si falló.
+    """
+    reporte = reporte_sesion()
+    huella = huella_resumen(df_resumen)
+    if reporte["huella"] != huella:
+        cancelar_reporte()
+        reporte["huella"] = huella
+
+    if generar and reporte["datos"] is None and reporte["trabajo"] is None:
+        ruta = os.path.join(os.getcwd(), ruta_plantilla)
+        if not os.path.exists(ruta):
+            st.error(f"⚠️ No se encontró la plantilla: {ruta}")
+            return None
+        # La plantilla se resuelve aquí: el hilo de trabajo no usa la caché de Streamlit
+        reporte["trabajo"] = obtener_pool_reportes().solicitar(huella, df_resumen, obtener_plantilla(ruta))
+
+    trabajo = reporte["trabajo"]
+    if trabajo is not None and trabajo.listo():
+        reporte["trabajo"] = None
+        obtener_pool_reportes().soltar(trabajo)
+        reporte["datos"], aviso, duracion = trabajo.futuro.result()
+        perfil = _perfil_actual.get()
+        if perfil:
+            perfil.registrar_etapa("escritura_libro", duracion)
+        if aviso:
+            st.sidebar.warning(aviso)
+    return reporte["datos"]
+
+
+def cancelar_reporte():
+    """Cancela el trabajo pendiente de la sesión y descarta el reporte anterior."""
+    reporte = reporte_sesion()
+    if reporte["trabajo"] is not None:
+        obtener_pool_reportes().soltar(reporte["trabajo"])
+    reporte.update(huella=None, datos=None, trabajo=None)
+
+
+@st.fragment(run_every=1.0)
+def progreso_reporte():
+    """Progreso del reporte en construcción; se refresca solo, sin rerun de toda la app."""
+    trabajo = reporte_sesion()["trabajo"]
+    if trabajo is None:
+        return
+    if trabajo.listo():
+        st.rerun()  # Rerun completo para entregar el reporte
+    st.progress(trabajo.progreso, text=f"Generando reporte... {trabajo.progreso:.0%}")
+    if st.button("Cancelar reporte"):
+        cancelar_reporte()
+        st.rerun()
+
+
+def reporte_sesion():
+    """
+    Artefactos del reporte de la sesión actual.
+
+    Viven solo en memoria dentro de `st.session_state`, de modo que sesiones
+    concurrentes nunca comparten ni sobrescriben un archivo en disco. Se guarda
+    únicamente el último reporte (o su trabajo pendiente) y se libera junto
+    con la sesión.
+    """
+    return st.session_state.setdefault("reporte", {"huella": None, "datos": None, "trabajo": None})
+
+
+def nombre_reporte():
+    """Nombre de descarga propio de la vivienda y del contenido del reporte."""
+    vivienda = st.session_state.get("nombre_vivienda") or "Vivienda"
+    vivienda = re.sub(r"[^\w\-]+", "_", vivienda).strip("_") or "Vivienda"
+    huella = reporte_sesion()["huella"] or ""
+    return f"Reporte_{vivienda}_{huella[:8]}.xlsx"
+
+
+class PlantillaReporte:
+    """
+    Plantilla del reporte cargada e indexada una sola vez.
+
+    Guarda una copia serializada del libro ya interpretado por openpyxl y el
+    conjunto de celdas combinadas, así cada exportación solo clona el libro en
+    memoria en lugar de volver a leer y analizar el archivo .xlsx.
+    """
+
+    def __init__(self, ruta):
+        from openpyxl import load_workbook  # Solo se importa al cargar la plantilla
+
+        wb = load_workbook(ruta)
+        ws = wb.active  # Hoja principal de la plantilla
+
+        # Obtener celdas combinadas para evitar sobreescritura
+        celdas = set()
+        for merged_range in ws.merged_cells.ranges:
+            for row in ws[merged_range.coord]:
+                for cell in row:
+                    celdas.add(cell.coordinate)
+        self.celdas_combinadas = frozenset(celdas)
+        self._libro_serializado = pickle.dumps(wb, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def nuevo_libro(self):
+        """Copia independiente del libro de la plantilla."""
+        wb = pickle.loads(self._libro_serializado)
+        for ws in wb.worksheets:
+            # pickle reconstruye las dimensiones como defaultdict sin fábrica:
+            # sin esto, consultar una fila o columna sin dimensión da KeyError
+            ws.row_dimensions.default_factory = ws._add_row
+            ws.column_dimensions.default_factory = ws._add_column
+        return wb
+
+
+@st.cache_resource
+def obtener_plantilla(ruta):
+    return PlantillaReporte(ruta)
+
 
-            # 5. Crear DataFrame resumen (ahora con la columna 'Categoria')
-            df_resumen = df_intermedio[[
-                "Item",
-                "Categoria",
-                "ACTIVIDAD DE OBRA - LISTA DE PRECIOS UNITARIOS",
-                "Unidad",
-                "Valor Unitario ofertado (**)",
-                "Total actividad",
-                "Costo total"
-            ]].copy()
+def libro_a_bytes(wb):
+    salida = BytesIO()
+    wb.save(salida)
+    return salida.getvalue()
 
-        # 6. Generar el archivo Excel con la plantilla
-        nueva_ruta = export_to_excel(df_resumen)
-        st.session_state["export_excel"] = nueva_ruta
 
+# Distribución de la plantilla del reporte
+FILA_INICIO_DATOS = 31  # Primera fila de actividades
+FILA_COSTO_DIRECTO = 93  # Fila "COSTO DIRECTO:"; el área de datos termina justo antes
+FILA_VALOR_TOTAL = 94  # Fila "VALOR TOTAL:" con la autosuma en la columna O
+COLUMNAS_REPORTE = (1, 2, 11, 12, 13, 14, 15)  # A, B, K, L, M, N, O
+COLUMNAS_MONEDA = (13, 14, 15)  # M, N y O
+FORMATO_MONEDA = '"$"#,##0'
+ENCABEZADOS_REPORTE = ("Item", "ACTIVIDAD DE OBRA - LISTA DE PRECIOS UNITARIOS", "Un", "Cant",
+                       "V. Unitario", "V. Parcial", "Subtotal")
 
-def export_to_excel(df_summary):
+
+def filas_reporte(df_summary):
+    """
+    Filas del reporte agrupadas por categoría, listas para escribir.
+
+    Cada bloque es el título de la categoría (columna A), sus actividades con
+    Total actividad > 0 y una fila en blanco. Las filas de actividad siguen el
+    orden de COLUMNAS_REPORTE: ítem, actividad, unidad, cantidad, valor
+    unitario, valor parcial y subtotal (el valor parcial replicado); los
+    valores en moneda se redondean sin decimales.
+
+    Returns:
+        list: Tuplas de 7 valores (None en las celdas vacías).
+    """
+    df_filtrado = df_summary[(df_summary["Total actividad"] > 0) & df_summary["Categoria"].fillna("").astype(bool)]
+    if df_filtrado.empty:
+        return []
+
+    # Columnas completas de una vez en lugar de recorrer fila por fila
+    unitarios = np.rint(pd.to_numeric(df_filtrado["Valor Unitario ofertado (**)"], errors="coerce").fillna(0)).astype(np.int64)
+    costos = np.rint(pd.to_numeric(df_filtrado["Costo total"], errors="coerce").fillna(0)).astype(np.int64)
+    actividades = list(zip(
+        df_filtrado["Item"], df_filtrado["ACTIVIDAD DE OBRA - LISTA DE PRECIOS UNITARIOS"], df_filtrado["Unidad"],
+        df_filtrado["Total actividad"], unitarios.tolist(), costos.tolist(), costos.tolist(),
+    ))
+
+    filas = []
+    categorias = df_filtrado["Categoria"].to_numpy()
+    # Las actividades de una categoría son contiguas: se cortan los bloques donde cambia
+    cortes = np.flatnonzero(categorias[1:] != categorias[:-1]) + 1
+    for inicio_bloque, fin_bloque in zip(np.r_[0, cortes], np.r_[cortes, len(categorias)]):
+        filas.append((categorias[inicio_bloque],) + (None,) * 6)
+        filas.extend(actividades[inicio_bloque:fin_bloque])
+        filas.append((None,) * 7)  # Fila en blanco entre categorías
+    return filas[:-1]
+
+
+def ampliar_area_datos(ws, filas_extra):
+    """
+    Inserta `filas_extra` filas antes de "COSTO DIRECTO:" y baja los totales y el pie.
+
+    openpyxl mueve las celdas pero no las alturas de fila, así que también se
+    desplazan las alturas del pie. Las filas insertadas quedan sin estilo:
+    toman el de la última fila de datos (92), cuyo borde inferior cierra la
+    tabla y pasa a la nueva última fila; las demás toman el de la fila 91.
+    """
+    ultima_fila = FILA_COSTO_DIRECTO - 1
+    estilos_interior = {celda.column: celda._style for celda in ws[ultima_fila - 1] if celda.has_style}
+    estilos_cierre = {celda.column: celda._style for celda in ws[ultima_fila] if celda.has_style}
+    alturas = {fila: dimension.height for fila, dimension in ws.row_dimensions.items()
+               if fila >= FILA_COSTO_DIRECTO}
+    ws.insert_rows(FILA_COSTO_DIRECTO, filas_extra)
+    for fila in range(ultima_fila, ultima_fila + filas_extra + 1):
+        estilos = estilos_cierre if fila == ultima_fila + filas_extra else estilos_interior
+        for columna, estilo in estilos.items():
+            ws.cell(fila, columna)._style = copy.copy(estilo)
+    for fila in alturas:
+        ws.row_dimensions[fila].height = None
+    for fila, altura in alturas.items():
+        ws.row_dimensions[fila + filas_extra].height = altura
+
+
+class ReporteCancelado(Exception):
+    """El reporte dejó de hacer falta mientras se construía."""
+
+
+@medido("escritura_libro")
+def export_to_excel(df_summary, plantilla=None, progreso=None, cancelado=None):
     """
     Llena la plantilla con las actividades > 0,
     agrupándolas por la columna 'Categoria' (encabezado en mayúsculas).
     Formatea las columnas M, N y O como moneda sin decimales; 
     además, el valor de la columna N se replica en la columna O (Subtotal).
-    Finalmente, se realiza una autosuma de la columna O (desde la fila 31 a la 93)
-    y se almacena en la celda O94.
-    """
-    ruta_plantilla = os.path.join(os.getcwd(), "Plantilla_Turbo_Final.xlsx")
-    if not os.path.exists(ruta_plantilla):
-        st.error(f"⚠️ No se encontró la plantilla: {ruta_plantilla}")
-        return None
+    Si las actividades no caben entre las filas 31 y 92, se insertan filas y
+    los totales y el pie bajan. Finalmente, se realiza una autosuma de la
+    columna O hasta la fila de "COSTO DIRECTO:" en la fila de "VALOR TOTAL:".
+    No usa `st`: puede correr en un hilo de trabajo (ver construir_reporte).
+
+    Args:
+        df_summary (pd.DataFrame): Resumen de actividades.
+        plantilla (PlantillaReporte, optional): Plantilla ya cargada; por defecto
+            la compartida del directorio de trabajo.
+        progreso (callable, optional): Recibe la fracción avanzada (0 a 1).
+        cancelado (threading.Event, optional): Si se activa, se abandona el reporte.
 
-    wb = load_workbook(ruta_plantilla)
+    Returns:
+        bytes: Contenido del archivo .xlsx generado, o None si falta la plantilla.
+
+    Raises:
+        ReporteCancelado: Si `cancelado` se activó durante la construcción.
+    """
+    def avanzar(fraccion):
+        if cancelado is not None and cancelado.is_set():
+            raise ReporteCancelado()
+        if progreso is not None:
+            progreso(fraccion)
+
+    if plantilla is None:
+        ruta_plantilla = os.path.join(os.getcwd(), "Plantilla_Turbo_Final.xlsx")
+        if not os.path.exists(ruta_plantilla):
+            return None
+        plantilla = obtener_plantilla(ruta_plantilla)
+
+    avanzar(0.0)
+    wb = plantilla.nuevo_libro()
     ws = wb.active  # Hoja principal de la plantilla
 
-    # Obtener celdas combinadas para evitar sobreescritura
-    celdas_combinadas = set()
-    for merged_range in ws.merged_cells.ranges:
-        for row in ws[merged_range.coord]:
-            for cell in row:
-                celdas_combinadas.add(cell.coordinate)
+    # 1. Filas agrupadas por categoría (solo actividades con Total actividad > 0)
+    filas = filas_reporte(df_summary)
+    avanzar(0.1)
+
+    # 2. Si no hay filas, devolver la plantilla vacía
+    if not filas:
+        return libro_a_bytes(wb)
+
+    # 3. Si no caben en el área de datos, se amplía moviendo totales y pie
+    filas_extra = max(0, FILA_INICIO_DATOS + len(filas) - FILA_COSTO_DIRECTO)
+    if filas_extra:
+        ampliar_area_datos(ws, filas_extra)
+
+    # 4. Escribir los bloques por número de fila y columna (sin armar coordenadas)
+    combinadas = plantilla.celdas_combinadas
+    for numero_fila, fila in enumerate(filas, start=FILA_INICIO_DATOS):
+        if (numero_fila - FILA_INICIO_DATOS) % 50 == 0:
+            avanzar(0.1 + 0.6 * (numero_fila - FILA_INICIO_DATOS) / len(filas))
+        for columna, valor in zip(COLUMNAS_REPORTE, fila):
+            if valor is None:
+                continue
+            if combinadas and ws.cell(numero_fila, columna).coordinate in combinadas:
+                continue
+            celda = ws.cell(numero_fila, columna, valor)
+            if columna in COLUMNAS_MONEDA:
+                celda.number_format = FORMATO_MONEDA
 
-    # 1. Filtrar solo actividades con Total actividad > 0
-    df_filtrado = df_summary[df_summary["Total actividad"] > 0].copy()
+    # 5. Autosuma de la columna O en la fila de "VALOR TOTAL:"
+    fila_costo_directo = FILA_COSTO_DIRECTO + filas_extra
+    total = ws.cell(FILA_VALOR_TOTAL + filas_extra, 15, f"=SUM(O{FILA_INICIO_DATOS}:O{fila_costo_directo})")
+    total.number_format = FORMATO_MONEDA
 
-    # 2. Si no hay filas, guardar y salir
-    if df_filtrado.empty:
-        st.warning("No hay actividades con valor > 0. El Excel quedará vacío.")
-        nueva_ruta = os.path.join(os.getcwd(), "Reporte_Resultado.xlsx")
-        wb.save(nueva_ruta)
-        return nueva_ruta
+    # Devolver el archivo resultante sin pasar por disco
+    avanzar(0.7)
+    datos = libro_a_bytes(wb)
+    avanzar(1.0)
+    return datos
 
-    # 3. Obtener el orden de las categorías tal como aparecen en df_filtrado
-    categorias_unicas = list(df_filtrado["Categoria"].dropna().unique())
 
-    # 4. Empezar a escribir en la fila 31 (espacio reservado para encabezados, etc.)
-    current_row = 31
+@medido("escritura_libro_continua")
+def export_to_excel_continuo(resumenes, destino=None):
+    """
+    Reporte sin plantilla escrito fila a fila con xlsxwriter en modo de memoria constante.
 
-    for cat in categorias_unicas:
-        if not cat:  # Omitir categorías vacías
+    Pensado para reportes muy largos o de varias viviendas: cada vivienda es
+    una sección con sus bloques por categoría y su costo directo, y al final
+    va el valor total de todas. La memoria no crece con el número de filas.
+
+    Args:
+        resumenes (iterable): Pares (nombre de la vivienda, resumen de actividades).
+        destino (str, optional): Ruta del archivo; si se omite, se devuelven los bytes.
+
+    Returns:
+        bytes | None: Contenido del .xlsx cuando no se indica `destino`.
+    """
+    import xlsxwriter  # Solo se importa en este modo
+
+    salida = destino or BytesIO()
+    wb = xlsxwriter.Workbook(salida, {"constant_memory": True})
+    ws = wb.add_worksheet("Presupuesto")
+    negrita = wb.add_format({"bold": True})
+    moneda = wb.add_format({"num_format": FORMATO_MONEDA})
+    moneda_negrita = wb.add_format({"num_format": FORMATO_MONEDA, "bold": True})
+    ws.set_column(0, 0, 10)
+    ws.set_column(1, 1, 70)
+    ws.set_column(2, 6, 14)
+
+    ws.write_row(0, 0, ENCABEZADOS_REPORTE, negrita)
+    fila_actual = 2
+    for nombre, df_summary in resumenes:
+        ws.write(fila_actual, 0, nombre, negrita)
+        fila_actual += 1
+        inicio_seccion = fila_actual
+        for fila in filas_reporte(df_summary):
+            for columna, valor in enumerate(fila):
+                if valor is not None:
+                    ws.write(fila_actual, columna, valor, moneda if columna >= 4 else None)
+            fila_actual += 1
+        ws.write(fila_actual, 1, "COSTO DIRECTO:", negrita)
+        ws.write_formula(fila_actual, 6, f"=SUM(G{inicio_seccion + 1}:G{fila_actual})", moneda_negrita)
+        fila_actual += 2
+
+    ws.write(fila_actual, 1, "VALOR TOTAL:", negrita)
+    ws.write_formula(fila_actual, 6, f'=SUMIF(B1:B{fila_actual},"COSTO DIRECTO:",G1:G{fila_actual})',
+                     moneda_negrita)
+    wb.close()
+    return None if destino else salida.getvalue()
+
+class TablaCSV:
+    """
+    Sección tabular de un CSV de MagicPlan.
+
+    Guarda el encabezado y cada fila como una tupla de textos alineada con las
+    columnas, a medida que se lee el archivo y sin DataFrames intermedios.
+    """
+
+    __slots__ = ("columnas", "filas")
+
+    def __init__(self, columnas):
+        self.columnas = tuple(columna.strip() for columna in columnas)
+        self.filas = []
+
+    def agregar(self, campos):
+        """Agrega una fila; se descartan las filas con más campos que el encabezado."""
+        n = len(self.columnas)
+        campos = [campo.strip() for campo in campos]
+        while len(campos) > n and not campos[-1]:
+            campos.pop()  # Comas sobrantes al final de la línea
+        if len(campos) > n:
+            return
+        if len(campos) < n:
+            campos.extend([""] * (n - len(campos)))
+        self.filas.append(tuple(campos))
+
+    def __len__(self):
+        return len(self.filas)
+
+
+def _cerrar_seccion(lineas):
+    """Clasifica una sección que no alcanzó a definirse como tabla mientras se leía."""
+    textos = [",".join(campos).strip() for campos in lineas]
+    if len(textos) == 1:
+        return {"titulo": textos[0]}
+
+    if all(":" in texto for texto in textos):
+        return {key.strip(): value.strip().strip(',')
+                for texto in textos if (parts := texto.split(':', 1)) and len(parts) == 2
+                for key, value in [parts]}
+
+    tabla = TablaCSV(lineas[0])
+    for campos in lineas[1:]:
+        tabla.agregar(campos)
+    return tabla
+
+
+def leer_secciones_csv(filas):
+    """
+    Recorre las filas de un CSV de MagicPlan en una sola pasada.
+
+    Las secciones están separadas por líneas en blanco. Una sección de una
+    línea es un título, una en la que todas las líneas tienen ':' es de
+    clave:valor, y en otro caso es tabular (la primera línea es el encabezado).
+    En cuanto aparece una línea sin ':' la sección pasa a modo tabular y sus
+    filas se agregan directamente, sin guardar el texto de la sección.
+
+    Args:
+        filas (iterable): Filas ya separadas en campos (p. ej. csv.reader).
+
+    Yields:
+        dict | TablaCSV: El contenido de cada sección, en orden.
+    """
+    pendientes = []
+    tabla = None
+
+    for campos in filas:
+        linea = ",".join(campos).strip()
+        if not linea:
+            if tabla is not None:
+                yield tabla
+            elif pendientes:
+                yield _cerrar_seccion(pendientes)
+            pendientes, tabla = [], None
             continue
 
-        # Tomar las actividades de esta categoría
-        df_cat = df_filtrado[df_filtrado["Categoria"] == cat]
-        if df_cat.empty:
+        if tabla is not None:
+            tabla.agregar(campos)
             continue
 
-        # Escribir el título de la categoría en la columna A
-        if f"A{current_row}" not in celdas_combinadas:
-            ws[f"A{current_row}"] = cat
-        current_row += 1
-
-        # Para cada actividad, definir el mapeo de columnas y valores
-        # Nuevo orden: A, B, K, M, L, N, O, G
-        for _, fila in df_cat.iterrows():
-            col_map = ["A", "B", "K", "M", "L", "N", "O", "G"]
-            # Se toma "Costo total" para columna N y se replica para columna O.
-            valores = [
-                fila["Item"],
-                fila["ACTIVIDAD DE OBRA - LISTA DE PRECIOS UNITARIOS"],
-                fila["Unidad"],
-                fila["Valor Unitario ofertado (**)"],
-                fila["Total actividad"],
-                fila["Costo total"],
-                fila["Costo total"],  # Replicado en columna O (Subtotal)
-                ""  # Puedes dejar en blanco o agregar otra información en la columna G
-            ]
-
-            for col, val in zip(col_map, valores):
-                celda = f"{col}{current_row}"
-                if celda not in celdas_combinadas:
-                    # Si la columna es M, N o O, redondeamos el valor (sin decimales) y aplicamos formato de moneda
-                    if col in ["M", "N", "O"]:
-                        try:
-                            valor_num = int(round(float(val)))
-                        except Exception as e:
-                            valor_num = 0
-                        ws[celda].value = valor_num
-                        ws[celda].number_format = '"$"#,##0'
-                    else:
-                        ws[celda].value = val
-            current_row += 1
-
-        # Fila en blanco entre categorías
-        current_row += 1
-
-    # Realizar la autosuma en la columna O y colocarla en la fila 94.
-    # Se suma desde la fila 31 hasta la 93 (ajusta el rango si es necesario)
-    ws["O94"] = "=SUM(O31:O93)"
-    ws["O94"].number_format = '"$"#,##0'
-
-    # Guardar el archivo resultante
-    nueva_ruta = os.path.join(os.getcwd(), "Reporte_Resultado.xlsx")
-    wb.save(nueva_ruta)
-
-    return nueva_ruta
+        pendientes.append(campos)
+        if len(pendientes) >= 2 and ":" not in linea:
+            tabla = TablaCSV(pendientes[0])
+            for pendiente in pendientes[1:]:
+                tabla.agregar(pendiente)
+            pendientes = []
+
+    if tabla is not None:
+        yield tabla
+    elif pendientes:
+        yield _cerrar_seccion(pendientes)
+
 
+@medido("ingesta_csv")
 def procesar_csv_bytes(file_bytes: BytesIO):
     """
     Procesa un archivo CSV desde un BytesIO y devuelve un diccionario con las tablas encontradas.
 
+    El archivo se lee línea por línea; las secciones tabulares se devuelven como
+    TablaCSV, los títulos y las secciones clave:valor como diccionarios.
+
     Args:
         file_bytes (BytesIO): Archivo CSV en memoria.
 
@@ -196,45 +1966,15 @@ def procesar_csv_bytes(file_bytes: BytesIO):
         tuple: Un diccionario con las tablas y un código de estado HTTP.
     """
     try:
-        content = file_bytes.getvalue().decode('utf-8', errors='replace')
-
-        raw_sections = re.split(r'\n\s*\n+', content)
-        sections = [sec.strip() for sec in raw_sections if sec.strip()]
-        
-        tablas = {}
-        for idx, section in enumerate(sections, start=1):
-            lines = section.split('\n')
-
-            if len(lines) == 1:
-                tablas[f"tabla_{idx}"] = {"titulo": lines[0]}
-                continue
-            
-            if all(':' in line for line in lines if line.strip()):
-                data = {key.strip(): value.strip().strip(',')
-                        for line in lines if (parts := line.split(':', 1)) and len(parts) == 2
-                        for key, value in [parts]}
-                tablas[f"tabla_{idx}"] = data
-                continue
-            
-            try:
-                read_csv_kwargs = {"encoding": "utf-8"}
-                if pd.__version__ >= "1.3.0":
-                    read_csv_kwargs["on_bad_lines"] = "skip"
-                else:
-                    read_csv_kwargs["error_bad_lines"] = False
-                
-                df = pd.read_csv(StringIO(section), **read_csv_kwargs)
-                
-                if not df.empty:
-                    df.columns = df.columns.str.strip()
-                    tablas[f"tabla_{idx}"] = df
-                    continue
-            except pd.errors.ParserError:
-                pass  
-
-            data = {f"columna_{i}": [part.strip() for part in line.split(',')] 
-                    if ',' in line else line.strip() for i, line in enumerate(lines)}
-            tablas[f"tabla_{idx}"] = data
+        file_bytes.seek(0)
+        texto = io.TextIOWrapper(file_bytes, encoding="utf-8-sig", errors="replace", newline="")
+        try:
+            tablas = {
+                f"tabla_{idx}": seccion
+                for idx, seccion in enumerate(leer_secciones_csv(csv.reader(texto)), start=1)
+            }
+        finally:
+            texto.detach()  # No cerrar el archivo subido junto con el lector
 
         return tablas, 200
     except UnicodeDecodeError:
@@ -242,58 +1982,481 @@ def procesar_csv_bytes(file_bytes: BytesIO):
     except Exception as e:
         return {"error": f"Error al procesar el archivo CSV: {str(e)}"}, 500
 
+MEDIDAS_MAGICPLAN = (
+    "MAGICPLAN - ÁREA PISO",
+    "MAGICPLAN - ÁREA PARED",
+    "MAGICPLAN - ÁREA CUBIERTA",
+    "MAGICPLAN - PERIMETRO PISO",
+    "MAGICPLAN - PERIMETRO CUBIERTA",
+    "MAGICPLAN - VOLUMEN",
+    "MAGICPLAN - ÁREA PARED CON APERTURAS",
+    "MAGICPLAN - ÁREA PUERTAS",
+    "MAGICPLAN - ÁREA VENTANAS",
+    "MAGICPLAN - ALTURA TECHO",
+)
+MEDIDA_ALTURA = "MAGICPLAN - ALTURA TECHO"
+
+# Columnas del CSV que pasan tal cual a una medida. Si faltan o no se pueden
+# leer, la medida queda sin dato (NaN) pero la habitación se conserva.
+COLUMNAS_MEDIDAS_ADICIONALES = {
+    "Volumen: m³": "MAGICPLAN - VOLUMEN",
+    "Paredes con apertura: m²": "MAGICPLAN - ÁREA PARED CON APERTURAS",
+    "Superficie de las puertas: m²": "MAGICPLAN - ÁREA PUERTAS",
+    "Superficie de ventanas: m²": "MAGICPLAN - ÁREA VENTANAS",
+    "Altura del techo": MEDIDA_ALTURA,
+}
+MENSAJE_OMITIDA = "Valor no numérico"
+MENSAJE_SIN_DATO = "Valor no numérico (medida sin dato)"
+
+COLUMNAS_ERRORES = ["tabla", "habitacion", "columna", "valor", "mensaje"]
+
+# Número con sufijo de unidad opcional: "2.34 m", "11,5", "3 m²"
+PATRON_NUMERO = r"^([-+]?(?:\d+(?:[.,]\d*)?|[.,]\d+))\s*[^\d\s]*$"
+
+
+class PropiedadesHabitaciones:
+    """
+    Medidas de MagicPlan por habitación en una matriz habitaciones x medidas.
+
+    Se comporta como el diccionario de diccionarios anterior para la lectura
+    (`keys()`, `props[habitacion][medida]`), pero los valores viven en un solo
+    arreglo float64 con todas las medidas de MEDIDAS_MAGICPLAN (NaN si una
+    medida adicional no vino en el CSV). Los problemas de lectura quedan en
+    `errores`.
+    """
+
+    def __init__(self, habitaciones, medidas, valores, errores=None):
+        self.habitaciones = list(habitaciones)
+        self.medidas = tuple(medidas)
+        self.valores = np.asarray(valores, dtype=np.float64).reshape(len(self.habitaciones), len(self.medidas))
+        self.indice = {habitacion: i for i, habitacion in enumerate(self.habitaciones)}
+        self.indice_medidas = {medida: j for j, medida in enumerate(self.medidas)}
+        self.errores = errores if errores is not None else pd.DataFrame(columns=COLUMNAS_ERRORES)
+
+    def keys(self):
+        return list(self.habitaciones)
+
+    def __iter__(self):
+        return iter(self.habitaciones)
+
+    def __len__(self):
+        return len(self.habitaciones)
+
+    def __contains__(self, habitacion):
+        return habitacion in self.indice
+
+    def __getitem__(self, habitacion):
+        fila = self.valores[self.indice[habitacion]]
+        return dict(zip(self.medidas, fila.tolist()))
+
+    def columna(self, medida):
+        """Vector con la medida de todas las habitaciones."""
+        return self.valores[:, self.indice_medidas[medida]]
+
+    def alturas(self, habitaciones):
+        """
+        Altura del techo de `habitaciones` leída del CSV.
+
+        Returns:
+            np.ndarray: Una altura por habitación; NaN si el CSV no la trae (o es 0).
+        """
+        alturas = np.full(len(habitaciones), np.nan)
+        j = self.indice_medidas.get(MEDIDA_ALTURA)
+        if j is None:
+            return alturas
+        for posicion, habitacion in enumerate(habitaciones):
+            i = self.indice.get(habitacion)
+            if i is not None and self.valores[i, j] > 0:
+                alturas[posicion] = self.valores[i, j]
+        return alturas
+
+
+def a_numero(textos):
+    """
+    Convierte de forma vectorizada textos de MagicPlan a float.
+
+    Todo el bloque pasa de una vez por `pd.to_numeric`; solo las celdas que
+    no son un número simple van a la expresión regular, que quita el sufijo
+    de unidad ("2.34 m" -> 2.34) y acepta coma decimal. Las celdas vacías
+    valen 0 y los textos que no son números quedan como NaN.
+
+    Args:
+        textos (array-like): Textos de una columna o de un bloque de columnas.
+
+    Returns:
+        np.ndarray: Valores float64 con la misma forma que `textos`.
+    """
+    textos = np.asarray(textos, dtype=object)
+    planos = textos.ravel()
+    valores = np.asarray(pd.to_numeric(planos, errors="coerce"), dtype=np.float64)
+    fallidas = np.flatnonzero(~np.isfinite(valores))
+    if len(fallidas):
+        valores[fallidas] = [_texto_a_numero(planos[k]) for k in fallidas]
+    return valores.reshape(textos.shape)
+
+
+_PATRON_NUMERO = re.compile(PATRON_NUMERO)
+
+
+def _texto_a_numero(texto):
+    # Celda que no es un número simple: vacía, con sufijo de unidad, coma decimal o texto
+    texto = "" if pd.isna(texto) else str(texto).strip()
+    if not texto:
+        return 0.0
+    coincidencia = _PATRON_NUMERO.match(texto)
+    return float(coincidencia.group(1).replace(",", ".")) if coincidencia else np.nan
+
+
+@medido("propiedades_habitaciones")
 def calcular_propiedades_habitacion(tablas):
     """
     Calcula valores para cada habitación en las tablas encontradas.
 
+    Las medidas se calculan por columnas sobre toda la tabla. Las habitaciones
+    con valores que no se pueden leer en las medidas principales se omiten; en
+    las medidas adicionales (volumen, aperturas, altura...) el valor queda sin
+    dato. Ambos casos se reportan en `errores`.
+
     Args:
         tablas (dict): Diccionario de tablas procesadas.
 
     Returns:
-        dict: JSON con los resultados en formato de diccionario.
+        PropiedadesHabitaciones: Matriz de medidas por habitación.
     """
-    resultados = {}
+    columnas_requeridas = ["Tierra Superficie: : m²", "Paredes sin apertura: m²"]
+    columnas_medidas = [
+        "Tierra Superficie: : m²",
+        "Paredes sin apertura: m²",
+        "Tierra Perímetro: m",
+        "Techo Perímetro: m",
+    ]
+
+    nombres, bloques, errores = [], [], []
 
     for tabla_key, value in tablas.items():
-        if isinstance(value, pd.DataFrame):
-            df = value.copy()
-            df.columns = df.columns.str.strip()
+        if not isinstance(value, TablaCSV) or not len(value):
+            continue
+        if not all(col in value.columnas for col in columnas_requeridas):
+            continue
 
-            columnas_requeridas = ["Tierra Superficie: : m²", "Paredes sin apertura: m²"]
-            if not all(col in df.columns for col in columnas_requeridas):
+        datos = np.array(value.filas, dtype=object)
+        # Todas las columnas de medidas se convierten en un solo paso
+        presentes = [columna for columna in [*columnas_medidas, *COLUMNAS_MEDIDAS_ADICIONALES]
+                     if columna in value.columnas]
+        bloque = datos[:, [value.columnas.index(columna) for columna in presentes]]
+        textos_columna = dict(zip(presentes, bloque.T))
+        numeros_columna = dict(zip(presentes, a_numero(bloque).T))
+
+        medidas = {}
+        invalidas = np.zeros(len(datos), dtype=bool)
+        for columna in columnas_medidas:
+            if columna not in value.columnas:
+                medidas[columna] = np.zeros(len(datos))
                 continue
+            textos = textos_columna[columna]
+            medidas[columna] = numeros_columna[columna]
+            malas = np.isnan(medidas[columna])
+            if malas.any():
+                errores.append(pd.DataFrame({
+                    "tabla": tabla_key,
+                    "habitacion": datos[malas, 0],
+                    "columna": columna,
+                    "valor": textos[malas],
+                    "mensaje": MENSAJE_OMITIDA,
+                }))
+                invalidas |= malas
+
+        # Medidas adicionales: sin dato (NaN) si faltan o no se pueden leer
+        adicionales = []
+        for columna in COLUMNAS_MEDIDAS_ADICIONALES:
+            if columna not in value.columnas:
+                adicionales.append(np.full(len(datos), np.nan))
+                continue
+            textos = textos_columna[columna]
+            numeros = numeros_columna[columna]
+            malas = np.isnan(numeros)
+            if malas.any():
+                errores.append(pd.DataFrame({
+                    "tabla": tabla_key,
+                    "habitacion": datos[malas, 0],
+                    "columna": columna,
+                    "valor": textos[malas],
+                    "mensaje": MENSAJE_SIN_DATO,
+                }))
+            adicionales.append(numeros)
+
+        superficie = medidas["Tierra Superficie: : m²"]
+        perimetro_interno = medidas["Tierra Perímetro: m"]
+        perimetro_techo = medidas["Techo Perímetro: m"]
+        # Si los perímetros de piso y techo difieren, la cubierta es inclinada (+15 %)
+        diferencia = np.abs(perimetro_interno - perimetro_techo)
+        techo = np.where(diferencia >= 0.1, superficie * 1.15, superficie)
+
+        bloque = np.column_stack([
+            superficie,
+            medidas["Paredes sin apertura: m²"],
+            techo,
+            perimetro_interno,
+            perimetro_techo,
+            *adicionales,
+        ])
+        validas = ~invalidas
+        nombres.append(datos[validas, 0])  # Primera columna es el nombre
+        bloques.append(bloque[validas])
+
+    df_errores = pd.concat(errores, ignore_index=True) if errores else pd.DataFrame(columns=COLUMNAS_ERRORES)
+    if not bloques:
+        return PropiedadesHabitaciones([], MEDIDAS_MAGICPLAN, np.empty((0, len(MEDIDAS_MAGICPLAN))), df_errores)
+
+    nombres = np.concatenate(nombres)
+    valores = np.vstack(bloques)
+    # Si una habitación se repite (p. ej. en otro piso), prevalece la última
+    unicas = ~pd.Index(nombres).duplicated(keep="last")
+    return PropiedadesHabitaciones(nombres[unicas], MEDIDAS_MAGICPLAN, valores[unicas], df_errores)
+
+CAPACIDAD_CACHE_INGESTA = 64  # Archivos (CSV o planos) que se conservan entre sesiones
+MAX_BYTES_CACHE_INGESTA = 256 * 2**20
+
+
+class CacheLRU:
+    """
+    Caché acotada de uso reciente (LRU), segura entre hilos.
 
-            for _, row in df.iterrows():
-                try:
-                    nombre_habitacion = row.iloc[0]  # Primera columna es el nombre
-
-                    superficie = float(row.get("Tierra Superficie: : m²", 0) or 0)
-                    paredes_sin_apertura = float(row.get("Paredes sin apertura: m²", 0) or 0)
-                    perimetro_interno = float(row.get("Tierra Perímetro: m", 0) or 0)
-                    perimetro_techo = float(row.get("Techo Perímetro: m", 0) or 0)
-                    diferencia = abs(perimetro_interno - perimetro_techo)
-                    techo = superficie * 1.15 if diferencia >= 0.1 else superficie
-
-                    resultados[nombre_habitacion] = {
-                        "MAGICPLAN - ÁREA PISO": superficie,
-                        "MAGICPLAN - ÁREA PARED": paredes_sin_apertura,
-                        "MAGICPLAN - ÁREA CUBIERTA": techo,
-                        "MAGICPLAN - PERIMETRO PISO": perimetro_interno,
-                        "MAGICPLAN - PERIMETRO CUBIERTA": perimetro_techo,
-                    }
-                    
-                except Exception as e:
-                    resultados[f"Error en {tabla_key}"] = f"Error al procesar habitación: {str(e)}"
+    Se comparte entre todas las sesiones; los valores guardados se tratan como
+    de solo lectura. Se acota por número de entradas y, con `max_bytes`, por
+    su tamaño total (tamano_objeto); la entrada más reciente se conserva
+    aunque sola supere el límite.
+    """
 
-    return resultados
+    def __init__(self, capacidad, max_bytes=None):
+        self.capacidad = capacidad
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._datos = OrderedDict()  # clave -> (valor, tamaño)
+        self._lock = threading.Lock()
+
+    def obtener(self, clave, calcular):
+        """Devuelve el valor de `clave`, calculándolo con `calcular()` si no está."""
+        with self._lock:
+            if clave in self._datos:
+                self._datos.move_to_end(clave)
+                return self._datos[clave][0]
+
+        valor = calcular()  # Fuera del candado para no bloquear otras sesiones
+        tamano = tamano_objeto(valor)
+
+        with self._lock:
+            if clave in self._datos:  # Otra sesión lo calculó mientras tanto
+                self.bytes -= self._datos[clave][1]
+            self._datos[clave] = (valor, tamano)
+            self._datos.move_to_end(clave)
+            self.bytes += tamano
+            while len(self._datos) > 1 and (
+                len(self._datos) > self.capacidad
+                or (self.max_bytes is not None and self.bytes > self.max_bytes)
+            ):
+                self.bytes -= self._datos.popitem(last=False)[1][1]
+        return valor
+
+    def consultar(self, clave):
+        """Valor de `clave` si sigue en la caché, sin calcularlo."""
+        with self._lock:
+            if clave not in self._datos:
+                return None
+            self._datos.move_to_end(clave)
+            return self._datos[clave][0]
+
+    def __len__(self):
+        return len(self._datos)
+
+
+@st.cache_resource
+def cache_ingesta():
+    return CacheLRU(CAPACIDAD_CACHE_INGESTA, MAX_BYTES_CACHE_INGESTA)
+
+
+def huella_bytes(datos):
+    return hashlib.sha256(datos).hexdigest()
+
+
+def ingerir_csv(datos):
+    """
+    Procesa el CSV de MagicPlan una sola vez por contenido.
 
-@st.cache_data
-def load_pdf(file):
-    return file.read()
+    Args:
+        datos (bytes): Contenido del archivo.
+
+    Returns:
+        tuple: (huella, código de estado, mensaje de error o None, PropiedadesHabitaciones).
+    """
+    contar("csv_recibidos")
+    huella = huella_bytes(datos)
+
+    def procesar():
+        contar("csv_procesados")
+        tablas, codigo = procesar_csv_bytes(BytesIO(datos))
+        if codigo != 200:
+            return codigo, tablas["error"], calcular_propiedades_habitacion({})
+        return codigo, None, calcular_propiedades_habitacion(tablas)
+
+    return (huella, *cache_ingesta().obtener(("csv", huella), procesar))
+
+
+def ingerir_plano(datos):
+    """Bytes del plano compartidos entre sesiones por huella de contenido."""
+    huella = huella_bytes(datos)
+    return huella, cache_ingesta().obtener(("plano", huella), lambda: datos)
+
+
+# ---------------------------------------------------------------------------
+# Planos: páginas y miniaturas bajo demanda
+# ---------------------------------------------------------------------------
+# Los bytes del plano viven solo en la caché compartida (cache_ingesta); la
+# sesión guarda su huella. Al navegador solo se envían imágenes reducidas de
+# las páginas que se ven, y la página en resolución completa se genera
+# únicamente cuando el usuario la pide. Las imágenes dibujadas se guardan en
+# otra caché compartida acotada por bytes, con la huella como clave.
+
+ANCHO_MINIATURA = 160  # Píxeles de ancho de las miniaturas de página
+ANCHO_VISTA = 900  # Píxeles de ancho de la página o imagen mostrada
+ANCHO_COMPLETO = 2400  # Píxeles de ancho de la página en resolución completa
+MINIATURAS_POR_FILA = 6
+CAPACIDAD_CACHE_PLANOS = 512  # Imágenes dibujadas (páginas, miniaturas) entre sesiones
+MAX_BYTES_CACHE_PLANOS = 64 * 2**20
+
+
+@st.cache_resource
+def cache_planos():
+    return CacheLRU(CAPACIDAD_CACHE_PLANOS, MAX_BYTES_CACHE_PLANOS)
+
+
+def modulo_pdfium():
+    """pypdfium2 (requirements.txt) o None si falta; sin él, el PDF lo dibuja el navegador con pdf_viewer."""
+    try:
+        import pypdfium2
+    except ImportError:
+        return None
+    return pypdfium2
+
+
+@st.cache_resource
+def candado_pdfium():
+    """
+    PDFium no es seguro entre hilos, ni siquiera con documentos distintos, y
+    pypdfium2 no agrega candado propio: toda llamada (abrir, contar, dibujar,
+    cerrar) pasa por este candado único del proceso.
+    """
+    return threading.Lock()
 
-@st.cache_data
-def load_image(file):
-    return Image.open(file)
+
+@st.cache_data(max_entries=CAPACIDAD_CACHE_INGESTA, show_spinner=False)
+def paginas_pdf(huella, _datos):
+    """Número de páginas del PDF (requiere pypdfium2)."""
+    with candado_pdfium():
+        documento = modulo_pdfium().PdfDocument(_datos)
+        try:
+            return len(documento)
+        finally:
+            documento.close()
+
+
+def pagina_pdf(huella, datos, pagina, ancho):
+    """
+    Página del PDF dibujada como PNG de `ancho` píxeles (requiere pypdfium2).
+
+    Args:
+        huella (str): Huella del plano (clave de la caché).
+        datos (bytes): Contenido del PDF.
+        pagina (int): Número de página, desde 1.
+        ancho (int): Ancho de la imagen en píxeles.
+
+    Returns:
+        bytes: Imagen PNG.
+    """
+    return cache_planos().obtener(("pagina", huella, pagina, ancho), lambda: _dibujar_pagina(datos, pagina, ancho))
+
+
+def _dibujar_pagina(datos, pagina, ancho):
+    with candado_pdfium():
+        documento = modulo_pdfium().PdfDocument(datos)
+        try:
+            hoja = documento[pagina - 1]
+            mapa = hoja.render(scale=ancho / hoja.get_width())
+            # Copia propia de los píxeles: así el mapa y la hoja se cierran aquí y
+            # ningún finalizador de PDFium corre después fuera del candado
+            imagen = mapa.to_pil().copy()
+            mapa.close()
+            hoja.close()
+        finally:
+            documento.close()
+    salida = BytesIO()
+    imagen.save(salida, format="PNG", optimize=True)
+    return salida.getvalue()
+
+
+def imagen_plano(huella, datos, ancho):
+    """
+    Plano en imagen reducido a `ancho` píxeles como máximo.
+
+    Returns:
+        bytes: Imagen PNG (si tiene transparencia) o JPEG.
+
+    Raises:
+        PIL.UnidentifiedImageError: Si el archivo no es una imagen válida.
+    """
+    return cache_planos().obtener(("imagen", huella, ancho), lambda: _reducir_imagen(datos, ancho))
+
+
+def _reducir_imagen(datos, ancho):
+    from PIL import Image
+
+    with Image.open(BytesIO(datos)) as imagen:
+        imagen.thumbnail((ancho, imagen.height))  # Conserva la proporción
+        salida = BytesIO()
+        if imagen.mode in ("RGBA", "LA", "P"):
+            imagen.save(salida, format="PNG", optimize=True)
+        else:
+            imagen.convert("RGB").save(salida, format="JPEG", quality=85)
+    return salida.getvalue()
+
+
+def bytes_plano(plano):
+    """Bytes del plano desde la caché compartida (None si ya salieron de ella)."""
+    return cache_ingesta().consultar(("plano", plano["huella"]))
+
+
+def vista_plano(plano):
+    """Muestra el plano de la sesión: miniaturas, página elegida y, si se pide, resolución completa."""
+    huella, datos = plano["huella"], bytes_plano(plano)
+    if datos is None:
+        return
+    if plano["tipo"] == "imagen":
+        st.subheader("Plano en Imagen")
+        if st.toggle("Ver en resolución completa", key="plano_completo"):
+            st.image(datos, caption="Plano en imagen", use_container_width=True)
+        else:
+            st.image(imagen_plano(huella, datos, ANCHO_VISTA), caption="Plano en imagen", use_container_width=True)
+        return
+
+    st.subheader("Plano PDF")
+    if modulo_pdfium() is None:
+        # Sin pypdfium2 no hay miniaturas: el navegador recibe y dibuja el PDF completo
+        from streamlit_pdf_viewer import pdf_viewer
+
+        pdf_viewer(datos, width="50%")
+        return
+
+    total = paginas_pdf(huella, datos)
+    pagina = st.number_input("Página", min_value=1, max_value=total, step=1, key="plano_pagina") if total > 1 else 1
+    completa = st.toggle("Ver en resolución completa", key="plano_completo")
+    if total > 1:
+        # Solo la fila de miniaturas que contiene la página actual
+        inicio_fila = (pagina - 1) // MINIATURAS_POR_FILA * MINIATURAS_POR_FILA + 1
+        paginas = range(inicio_fila, min(inicio_fila + MINIATURAS_POR_FILA, total + 1))
+        for columna, numero in zip(st.columns(MINIATURAS_POR_FILA), paginas):
+            columna.image(pagina_pdf(huella, datos, numero, ANCHO_MINIATURA), caption=f"Página {numero}")
+    st.image(pagina_pdf(huella, datos, pagina, ANCHO_COMPLETO if completa else ANCHO_VISTA),
+             use_container_width=True)
 
 def inicio():
     
@@ -304,8 +2467,12 @@ def inicio():
 
     # Carga automática del archivo Excel sin necesidad de subirlo manualmente
     try:
-        st.session_state["costos_excel"] = load_excel_local()
+        st.session_state["catalogo"] = obtener_catalogo()
         st.success("Archivo Excel de costos cargado correctamente desde el código.")
+        if st.session_state["catalogo"].errores_reglas:
+            st.warning("Algunas reglas de cantidad del catálogo no son válidas; esas actividades piden la cantidad al usuario.")
+            st.dataframe(pd.DataFrame(st.session_state["catalogo"].errores_reglas, columns=["Item", "Regla", "Error"]),
+                         hide_index=True)
     except Exception as e:
         st.error(f"Error al cargar el archivo Excel: {str(e)}")
 
@@ -317,26 +2484,59 @@ def inicio():
     if plano_file and resultados_csv:
         file_extension = plano_file.name.split(".")[-1].lower()
 
-        # Si es un PDF, lo carga con load_pdf()
-        if file_extension == "pdf":
-            st.session_state["plano_pdf"] = load_pdf(plano_file)
-            st.success("Archivo PDF cargado correctamente.")
+        # Si los bytes del plano salieron de la caché compartida, se vuelven a poner desde el cargador
+        plano = st.session_state.get("plano")
+        if plano is not None and bytes_plano(plano) is None:
+            ingerir_plano(plano_file.getvalue())
+
+        # Solo se vuelve a leer el plano cuando se sube un archivo distinto
+        if st.session_state.get("plano_id") != plano_file.file_id:
+            huella_plano, datos_plano = ingerir_plano(plano_file.getvalue())
+            if st.session_state.get("huella_plano") != huella_plano:
+                st.session_state.pop("plano", None)
+                st.session_state.pop("plano_pagina", None)  # Otro plano: desde la primera página
+                tipo = "pdf" if file_extension == "pdf" else "imagen"
+                try:
+                    if tipo == "imagen":
+                        imagen_plano(huella_plano, datos_plano, ANCHO_VISTA)  # Valida y deja lista la vista
+                    # La sesión guarda solo la huella; los bytes quedan en la caché compartida
+                    st.session_state["plano"] = {"huella": huella_plano, "tipo": tipo}
+                except Exception as e:
+                    st.error(f"No se pudo leer el plano: {str(e)}")
+                st.session_state["huella_plano"] = huella_plano
+            st.session_state["plano_id"] = plano_file.file_id
 
-        # Si es una imagen (PNG, JPG, JPEG), la carga con load_image()
-        elif file_extension in ["png", "jpg", "jpeg"]:
-            st.session_state["plano_img"] = load_image(plano_file)
+        plano = st.session_state.get("plano")
+        if plano is not None and plano["tipo"] == "pdf":
+            st.success("Archivo PDF cargado correctamente.")
+        elif plano is not None:
             st.success("Imagen cargada correctamente.")
 
-        # Procesar el archivo CSV como antes
-        tablas, codigo = procesar_csv_bytes(resultados_csv)
-        st.session_state["resultados_csv"] = calcular_propiedades_habitacion(tablas)
+        # Procesar el CSV solo si su contenido cambió
+        if st.session_state.get("csv_id") != resultados_csv.file_id:
+            huella_csv, codigo, mensaje, propiedades = ingerir_csv(resultados_csv.getvalue())
+            if st.session_state.get("huella_csv") != huella_csv:
+                st.session_state["resultados_csv"] = propiedades
+                olvidar_vivienda()  # Otra vivienda: cantidades y widgets nuevos
+                st.session_state["nombre_vivienda"] = os.path.splitext(resultados_csv.name)[0]
+                st.session_state["error_csv"] = mensaje
+                st.session_state["huella_csv"] = huella_csv
+            st.session_state["csv_id"] = resultados_csv.file_id
+
+        if st.session_state.get("error_csv"):
+            st.error(st.session_state["error_csv"])
+
+        errores = st.session_state["resultados_csv"].errores
+        if not errores.empty:
+            omitidas = errores.loc[errores["mensaje"] == MENSAJE_OMITIDA, "habitacion"].nunique()
+            if omitidas:
+                st.warning(f"Se omitieron {omitidas} habitaciones con valores que no se pudieron leer.")
+            else:
+                st.warning("Algunas medidas no se pudieron leer y quedaron sin dato.")
+            st.dataframe(errores, hide_index=True)
 
         st.success("Todos los archivos han sido cargados correctamente.")
 
-@st.cache_data
-def load_image(file):
-    return Image.open(file)
-
 def detectar_desconexion():
     """Inserta un script en JavaScript para detectar desconexión y reconectar automáticamente"""
     html_code = """
@@ -349,6 +2549,8 @@ def detectar_desconexion():
     setInterval(checkConnection, 5000); // Verifica la conexión cada 5 segundos
     </script>
     """
+    import streamlit.components.v1 as components
+
     components.html(html_code, height=0)
 
 
@@ -361,18 +2563,32 @@ def main():
     if st.sidebar.button("Reiniciar aplicación"):
         st.session_state.clear()  # Limpia todos los valores almacenados
         st.rerun()
+
+    # ⏱️ Instrumentación opcional: con el interruptor apagado no se mide nada
+    perfil = None
+    if st.sidebar.toggle("Instrumentación", key="instrumentacion"):
+        perfil = st.session_state.setdefault("perfil", Perfilador())
+    _perfil_actual.set(perfil)
+    inicio_rerun = time.perf_counter()
+
+    # 🔹 Límite de memoria de la sesión: se descartan artefactos que se pueden rehacer
+    descartados = aplicar_presupuesto_memoria()
+    if descartados:
+        st.sidebar.info(f"Para no superar el límite de memoria de la sesión se liberó {', '.join(descartados)}.")
     
     # 🔹 Valor máximo permitido fijo
-    max_total = 15600000  # 15.600.000
+    max_total = VALOR_MAXIMO
 
     # 🔹 Restar automáticamente 1.300.000 para obtener el diagnóstico
-    diagnostico = max_total - 1300000  # 15.600.000 - 1.300.000
+    diagnostico = max_total - VALOR_DIAGNOSTICO
 
     # 📌 Mostrar ambos valores en la barra lateral
     st.sidebar.markdown(f"**Valor máximo permitido: ${max_total:,.2f}**")
     st.sidebar.markdown(f"**Valor con DIAGNÓSTICO: ${diagnostico:,.2f}** 🏥")
 
     # 🔹 El usuario aún puede reducir el costo con un porcentaje
+    if "porcentaje_pendiente" in st.session_state:
+        st.session_state["max_porcentaje"] = st.session_state.pop("porcentaje_pendiente")
     max_porcentaje = st.sidebar.number_input(
         "Ingrese el porcentaje de costos a reducir", 
         min_value=0.0, 
@@ -383,18 +2599,24 @@ def main():
     )
 
     # 🔹 Calcular el nuevo costo permitido después de la reducción
-    st.session_state['max_costo'] = diagnostico * (100 - max_porcentaje) / 100
+    st.session_state['max_costo'] = calcular_max_costo(max_porcentaje)
 
     # 📌 Mostrar el valor final después de la reducción
     st.sidebar.markdown(f"**Costo permitido después de reducción: ${st.session_state['max_costo']:,.2f}**")
 
     # 🔹 Continuar con las pantallas de la aplicación
-    inicio()
-    vista_archivos(st.session_state['max_costo'])
-
-@st.cache_data
-def load_pdf(file):
-    return file.read()
+    modo = st.sidebar.radio("Modo", ["Vivienda", "Cartera"], horizontal=True, key="modo")
+    try:
+        if modo == "Cartera":
+            vista_cartera(obtener_catalogo())
+        else:
+            inicio()
+            vista_archivos(st.session_state['max_costo'])
+    finally:
+        if perfil:
+            perfil.registrar_rerun(time.perf_counter() - inicio_rerun, tamano_sesion())
+    if perfil:
+        panel_instrumentacion(perfil)
 
 @st.cache_data
 def load_csv(file):
@@ -403,12 +2625,6 @@ def load_csv(file):
 # Ruta del archivo Excel local (ajusta esto a tu ubicación real)
 RUTA_ARCHIVO_COSTOS = "TURBO_ARCHIVO_PARA_TRABAJAR.xlsx"
 
-# Función para cargar el archivo Excel desde la ruta local
-@st.cache_data
-def load_excel_local():
-    return pd.read_excel(RUTA_ARCHIVO_COSTOS, sheet_name="FORMATO DE OFERTA ECONÓMICA")
-
-
 def ultimas_dos_palabras(texto: str) -> str:
     palabras = texto.split()  # Dividir el texto en palabras
     return " ".join(palabras[-2:]) if len(palabras) >= 2 else texto
@@ -418,90 +2634,127 @@ def verificar_palabras(texto, lista_referencia):
     lista_referencia = set(lista_referencia)  # Convertir la lista en conjunto
     return not palabras.isdisjoint(lista_referencia)
 
+ACTIVIDADES_POR_PAGINA = 20
+
+
+def mostrar_actividad(catalogo, almacen, habitacion, fila, sugerida):
+    """
+    Controles de una actividad del catálogo para una habitación.
+
+    Los controles salen de la regla compilada de la actividad: se piden los
+    valores que la regla necesita y no se conocen (U, y H si el CSV no trae la
+    altura) o, si no falta ninguno, se muestra la cantidad sugerida
+    (`sugerida`, NaN si no hay) para confirmarla.
+    """
+    item = catalogo.items[fila]
+    actividad = catalogo.actividades[fila]
+    unidad = catalogo.unidades[fila]
+    valor_unitario = catalogo.valores[fila]
+    regla = catalogo.reglas[fila]
+    guardada = almacen.cantidad(habitacion, fila)
+
+    check = st.checkbox(
+        f"{item} -- {actividad} [Unidad: {unidad}] (Precio unitario: ${valor_unitario:,.2f})",
+        value=almacen.seleccionada(habitacion, fila),
+        key=f"check_{habitacion}_{actividad}"
+    )
+    almacen.fijar_seleccion(habitacion, fila, check)
+    if not check:
+        return
+
+    cantidad_key = f"cantidad_{habitacion}_{actividad}"
+    entradas = {}
+    if regla.usa_usuario:
+        por_unidad = unidad in ["UN", "UND"]
+        # Si la regla es solo U, lo que escribe el usuario es la cantidad guardada
+        inicial = "min" if guardada is None or regla.expresion != "U" else (int(guardada) if por_unidad else guardada)
+        etiqueta = f"Ingrese la cantidad ({unidad})." if regla.expresion == "U" else "Ingrese el valor."
+        entradas["U"] = st.number_input(etiqueta, value=inicial, min_value=0 if por_unidad else 0.00, key=cantidad_key, step=1 if por_unidad else 0.0001)
+    if regla.usa_altura and almacen.altura(habitacion) is None:
+        # Solo si el CSV no trae la altura del techo de la habitación
+        entradas["H"] = st.number_input(f"Ingrese la altura (metros).", value=almacen.altura(habitacion) or 0.0, min_value=0.00, key=cantidad_key+"_aux")
+
+    if entradas:
+        if regla.expresion != "U":
+            st.caption(f"Cantidad = {regla.descripcion()}" + ("" if guardada is None else f" (guardada: {guardada:,.2f})"))
+        if st.button(f"Guardar cantidad", key=f"button_{habitacion}_{actividad}"):
+            if "H" in entradas:
+                almacen.fijar_altura(habitacion, entradas["H"])
+            cantidad = calcular_cantidad(catalogo, st.session_state["resultados_csv"], habitacion, fila,
+                                         altura=entradas.get("H", almacen.altura(habitacion) or np.nan), usuario=entradas.get("U", np.nan))
+            almacen.fijar_cantidad(habitacion, fila, cantidad)
+            st.success(f"Valor guardado para {actividad}: ${almacen.valor(habitacion, fila, valor_unitario):,.2f}")
+    else:
+        inicial = guardada if guardada is not None else (0.0 if np.isnan(sugerida) else float(sugerida))
+        cantidad = st.number_input(f"Valor MagicPlan ({regla.descripcion()}) [Unidad: {unidad}]", value=inicial, min_value=0.0, key=cantidad_key)
+        almacen.fijar_cantidad(habitacion, fila, cantidad)
+        st.success(f"Valor guardado para {actividad}: ${almacen.valor(habitacion, fila, valor_unitario):,.2f}")
+
 def vista_archivos(max_total):
     st.title("Modificaciones a realizar")
 
-    # Mostrar el archivo PDF si se ha subido
-    if "plano_pdf" in st.session_state:
-        st.subheader("Plano PDF")
-        pdf_viewer(st.session_state["plano_pdf"], width="50%")
-
-    # Mostrar la imagen si el usuario subió una imagen en lugar de un PDF
-    elif "plano_img" in st.session_state:
-        st.subheader("Plano en Imagen")
-        st.image(st.session_state["plano_img"], caption="Plano en imagen", use_container_width=True)
+    # Mostrar el plano (PDF o imagen) si se ha subido
+    if "plano" in st.session_state:
+        vista_plano(st.session_state["plano"])
 
     # Si los archivos CSV y Excel están cargados, mostrar la interfaz de modificaciones
-    if "resultados_csv" in st.session_state and "costos_excel" in st.session_state:
+    if "resultados_csv" in st.session_state and "catalogo" in st.session_state:
         st.subheader("Selección de Habitaciones")
         habitaciones = [key for key in st.session_state["resultados_csv"].keys() if "piso" not in key.lower()]
-        actividades = st.session_state["costos_excel"]
-        estados = {}
-        subtotales = {}
-
-        for habitacion in habitaciones:
-            activo = habitacion.startswith("#")
-            estados[habitacion] = st.checkbox(habitacion, value=activo, key=f"habitacion_{habitacion}")
-            subtotal = 0.0
-
-            if estados[habitacion]:
-                st.subheader(f"🏠 Modificaciones de {habitacion}")  # Quitamos el expander de habitación
-
-                # Crear un diccionario para almacenar categorías con actividades
-                categorias_actividades = {}
-                categoria_actual = None
-
-                for _, row in actividades.iterrows():
-                    actividad = row.get("ACTIVIDAD DE OBRA - LISTA DE PRECIOS UNITARIOS", "")
-                    unidad = row.get("Unidad", None)
-                    item = row.get("Item", "")
-                    valor_unitario = row.get("Valor Unitario ofertado (**)", 0.0)
-                    medicion = row.get("ÁREA", "")
-                    formula = row.get("FORMULA", "")
-                    formula = "" if pd.isna(formula) else formula
-
-                    # Identificar si el título es una categoría (mayúsculas)
-                    if actividad.isupper():
-                        categoria_actual = actividad
-                        categorias_actividades[categoria_actual] = []
-                    elif categoria_actual:
-                        categorias_actividades[categoria_actual].append((item, actividad, unidad, valor_unitario, medicion, formula))
-
-                # Mostrar las categorías con sus actividades dentro de `st.expander()`
-                for categoria, lista_actividades in categorias_actividades.items():
-                    with st.expander(f"📂 {categoria}", expanded=False):
-                        for item, actividad, unidad, valor_unitario, medicion, formula in lista_actividades:
-                            check = st.checkbox(f"{item} -- {actividad} [Unidad: {unidad}] (Precio unitario: ${valor_unitario:,.2f})", key=f"check_{habitacion}_{actividad}")
-
-                            if check:
-                                cantidad_key = f"cantidad_{habitacion}_{actividad}"
-                                valor_guardado_key = f"valor_{habitacion}_{actividad}"
-                                if valor_guardado_key not in st.session_state:
-                                    st.session_state[valor_guardado_key] = 0.0
-                                if "USUARIO" in medicion.upper():
-                                    cantidad = st.number_input(f"Ingrese la cantidad ({unidad}).", min_value=0 if unidad in ["UN", "UND"] else 0.00, key=cantidad_key, step=1 if unidad in ["UN", "UND"] else 0.0001)
-                                    if st.button(f"Guardar cantidad", key=f"button_{habitacion}_{actividad}"):
-                                        st.session_state[valor_guardado_key] = cantidad * valor_unitario
-                                        st.success(f"Valor guardado para {actividad}: ${st.session_state[valor_guardado_key]:,.2f}")
-                                else:
-                                    if "ALTURA" in formula:    
-                                        cantidad = st.number_input(f"Valor MagicPlan ({ultimas_dos_palabras(medicion)})", value=st.session_state["resultados_csv"][habitacion][medicion], min_value=0.0, key=cantidad_key)
-                                        valor_input = st.number_input(f"Ingrese la altura (metros).", min_value=0.00, key=cantidad_key+"_aux")
-                                        if st.button(f"Guardar cantidad", key=f"button_{habitacion}_{actividad}"):
-                                            st.session_state[valor_guardado_key] = cantidad * valor_unitario * valor_input
-                                            st.success(f"Valor guardado para {actividad}: ${st.session_state[valor_guardado_key]:,.2f}")
-                                    elif formula != "":
-                                        cantidad = st.number_input(f"Ingrese la cantidad ({unidad}).", value=st.session_state["resultados_csv"][habitacion][medicion], min_value=0.0, key=cantidad_key)
-                                        if st.button(f"Guardar cantidad", key=f"button_{habitacion}_{actividad}"):
-                                            st.session_state[valor_guardado_key] = cantidad * valor_unitario
-                                            st.success(f"Valor guardado para {actividad}: ${st.session_state[valor_guardado_key]:,.2f}")
-                                    else:    
-                                        cantidad = st.number_input(f"Valor MagicPlan ({ultimas_dos_palabras(medicion)}) [Unidad: {unidad}]", value=st.session_state["resultados_csv"][habitacion][medicion], min_value=0.0, key=cantidad_key)
-                                        st.session_state[valor_guardado_key] = cantidad * valor_unitario
-                                        st.success(f"Valor guardado para {actividad}: ${st.session_state[valor_guardado_key]:,.2f}")
-                                subtotal += st.session_state[valor_guardado_key]
-
-            subtotales[habitacion] = subtotal
+        catalogo = st.session_state["catalogo"]
+        almacen = obtener_almacen(habitaciones, catalogo)
+
+        with medir_etapa("widgets_habitaciones"):
+            for habitacion in habitaciones:
+                activo = bool(almacen.activas[almacen.indice[habitacion]])
+                activo = st.checkbox(habitacion, value=activo, key=f"habitacion_{habitacion}")
+                almacen.fijar_activa(habitacion, activo)
+
+        # Solo se construyen los controles de la habitación y la categoría abiertas;
+        # lo elegido en las demás queda guardado en el almacén de cantidades.
+        activas = [habitacion for habitacion in habitaciones if almacen.activas[almacen.indice[habitacion]]]
+        if activas:
+            st.subheader("🏠 Modificaciones por habitación")
+            col_habitacion, col_categoria = st.columns(2)
+            habitacion = col_habitacion.selectbox("Habitación", activas, key="habitacion_abierta")
+
+            seleccionadas = almacen.seleccion[almacen.indice[habitacion]]
+            por_categoria = np.bincount(
+                catalogo.categoria_fila[seleccionadas & (catalogo.categoria_fila >= 0)],
+                minlength=len(catalogo.categorias)
+            )
+            # Solo categorías con actividades: las vacías (p. ej. PRELIMINARES) mostrarían una lista vacía
+            categoria = col_categoria.selectbox(
+                "Categoría",
+                [c for c in catalogo.categorias if len(catalogo.indice_categorias[c])],
+                format_func=lambda c: f"📂 {c}",
+                key="categoria_abierta"
+            )
+            resumen = [f"{c} ({n})" for c, n in zip(catalogo.categorias, por_categoria) if n]
+            if resumen:
+                st.caption(f"Actividades elegidas en {habitacion}: " + ", ".join(resumen))
+
+            filas = catalogo.indice_categorias[categoria]
+            paginas = max(1, (len(filas) + ACTIVIDADES_POR_PAGINA - 1) // ACTIVIDADES_POR_PAGINA)
+            pagina = 1
+            if paginas > 1:
+                pagina = st.selectbox("Página", range(1, paginas + 1), format_func=lambda p: f"{p} de {paginas}",
+                                      key=f"pagina_{categoria}")
+            inicio_pagina = (pagina - 1) * ACTIVIDADES_POR_PAGINA
+
+            filas_pagina = filas[inicio_pagina:inicio_pagina + ACTIVIDADES_POR_PAGINA]
+            contar("actividades_mostradas", len(filas_pagina))
+            # Cantidades sugeridas de toda la vivienda en una pasada por las reglas del catálogo
+            with medir_etapa("reglas_cantidades"):
+                sugeridas = cantidades_por_defecto(catalogo, st.session_state["resultados_csv"],
+                                                   almacen.habitaciones, almacen.alturas)
+            with medir_etapa("widgets_actividades"):
+                for fila in filas_pagina:
+                    mostrar_actividad(catalogo, almacen, habitacion, fila, sugeridas[almacen.indice[habitacion], fila])
+
+        # Subtotales por habitación: un solo producto matriz-vector sobre el almacén
+        subtotales = dict(zip(almacen.habitaciones, almacen.subtotales(catalogo.valores)))
+        panel_proyecto(almacen, catalogo)
 
         total_general = sum(subtotales.values())
         st.sidebar.subheader("Subtotales por Habitación")
@@ -509,21 +2762,32 @@ def vista_archivos(max_total):
         st.sidebar.dataframe(df_subtotales, hide_index=True)
         st.sidebar.subheader("Total General")
 
+        if total_general > max_total or total_general <= 0:
+            # Sin reporte posible: un trabajo pendiente es de un resumen que ya no vale
+            cancelar_reporte()
         if total_general > max_total:
             st.sidebar.markdown(f"<span style='color: red; font-weight: bold;'>Total: ${total_general:,.2f}</span>", unsafe_allow_html=True)
             st.sidebar.warning('Se ha superado el monto máximo permisible.')
+            panel_ajuste(catalogo, almacen, max_total)
         else:
             st.sidebar.markdown(f"Total: ${total_general:,.2f}")
-            obtener_tabla_habitaciones()
-            
-            # 🔹 MODIFICACIÓN: Descargar el archivo Excel generado con la plantilla
-            if "export_excel" in st.session_state and total_general > 0:
+            # 🔹 MODIFICACIÓN: El Excel se genera solo cuando el usuario lo pide
+            # y el contenido cambió desde la última vez
+            if total_general > 0:
                 try:
-                    with open(st.session_state["export_excel"], "rb") as file:
+                    df_resumen = obtener_tabla_habitaciones()
+                    reporte = reporte_bajo_demanda(df_resumen, generar=False)
+                    if reporte is None and reporte_sesion()["trabajo"] is None and st.sidebar.button("Generar reporte"):
+                        reporte = reporte_bajo_demanda(df_resumen, generar=True)
+                    if reporte is None and reporte_sesion()["trabajo"] is not None:
+                        # Se sigue editando mientras el reporte se construye
+                        with st.sidebar:
+                            progreso_reporte()
+                    if reporte:
                         st.sidebar.download_button(
                             label="Descargar Reporte",
-                            data=file,
-                            file_name="Reporte_Resultado.xlsx",
+                            data=reporte,
+                            file_name=nombre_reporte(),
                             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
                         )
                 except Exception as e:
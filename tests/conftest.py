@@ -0,0 +1,46 @@
+import logging
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Sin servidor de Streamlit los decoradores de caché avisan al importar script
+logging.disable(logging.WARNING)
+import script  # noqa: E402
+logging.disable(logging.NOTSET)
+
+
+@pytest.fixture
+def construir_catalogo():
+    """
+    Catálogo pequeño a partir de categorías de actividades.
+
+    Cada categoría es una lista de tuplas (precio, unidad, área, medición);
+    los ítems quedan numerados "1.1", "1.2", ... y las categorías "CAT 1", ...
+    """
+    def construir(categorias):
+        columnas = {nombre: [] for nombre in script.CatalogoPrecios.COLUMNAS}
+        filas = []
+        for c, actividades in enumerate(categorias, start=1):
+            filas.append((str(c), f"CAT {c}", "", "", "", "", "", 0.0))
+            for k, (precio, unidad, area, medicion) in enumerate(actividades, start=1):
+                filas.append((f"{c}.{k}", f"Actividad {c}.{k}", unidad, area, "", medicion, "", float(precio)))
+        for fila in filas:
+            for nombre, valor in zip(script.CatalogoPrecios.COLUMNAS, fila):
+                columnas[nombre].append(valor)
+        return script.CatalogoPrecios(columnas)
+    return construir
+
+
+@pytest.fixture
+def almacen_completo():
+    """Almacén de una habitación activa con cantidad 1 en todas las actividades."""
+    def construir(catalogo, cantidad=1.0):
+        almacen = script.AlmacenCantidades(["#SALA"], len(catalogo), activas=[True])
+        actividades = ~catalogo.es_categoria
+        almacen.seleccion[0, actividades] = True
+        almacen.cantidades[0, actividades] = cantidad
+        return almacen
+    return construir
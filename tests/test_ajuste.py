@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+import script
+
+
+def un(*precios):
+    return [(precio, "UN", "USUARIO", "") for precio in precios]
+
+
+def test_sin_exceso_conserva_todo(construir_catalogo, almacen_completo):
+    catalogo = construir_catalogo([un(100, 200)])
+    ajuste = script.ajustar_presupuesto(catalogo, almacen_completo(catalogo), 1000)
+    assert (ajuste["Cantidad ajustada"] == ajuste["Cantidad"]).all()
+
+
+@pytest.mark.parametrize("reducir", [False, True])
+def test_tope_cero_descarta_todo(construir_catalogo, almacen_completo, reducir):
+    catalogo = construir_catalogo([un(100, 200)])
+    ajuste = script.ajustar_presupuesto(catalogo, almacen_completo(catalogo), 0.0, reducir=reducir)
+    assert len(ajuste) == 2
+    assert (ajuste["Cantidad ajustada"] == 0).all()
+    assert ajuste["Costo ajustado"].sum() == 0
+
+
+def test_nunca_supera_el_tope(construir_catalogo, almacen_completo):
+    precios = np.random.default_rng(0).integers(8_000, 60_000, 200)
+    catalogo = construir_catalogo([un(*precios)])
+    ajuste = script.ajustar_presupuesto(catalogo, almacen_completo(catalogo), 3_000_000)
+    assert ajuste["Costo ajustado"].sum() <= 3_000_000
+
+
+def test_sobrante_del_redondeo_se_rellena(construir_catalogo, almacen_completo):
+    precios = np.random.default_rng(1).integers(8_000, 60_000, 600)
+    catalogo = construir_catalogo([un(*precios)])
+    maximo = 14_300_000
+    ajuste = script.ajustar_presupuesto(catalogo, almacen_completo(catalogo), maximo)
+    sobrante = maximo - ajuste["Costo ajustado"].sum()
+    descartadas = ajuste[ajuste["Cantidad ajustada"] == 0]
+    assert sobrante >= 0
+    assert not (descartadas["Costo"] <= sobrante).any()
+
+
+def test_prioridad_mayor_se_conserva_primero(construir_catalogo, almacen_completo):
+    catalogo = construir_catalogo([un(600), un(600)])
+    ajuste = script.ajustar_presupuesto(catalogo, almacen_completo(catalogo), 1000, {"CAT 1": 1, "CAT 2": 5})
+    conservadas = ajuste.loc[ajuste["Cantidad ajustada"] > 0, "Item"].tolist()
+    assert conservadas == ["2.1"]
+
+
+def test_prioridad_cero_se_conserva_si_cabe(construir_catalogo, almacen_completo):
+    catalogo = construir_catalogo([un(5_000, 5_000), un(100)])
+    ajuste = script.ajustar_presupuesto(catalogo, almacen_completo(catalogo), 9_950, {"CAT 1": 1, "CAT 2": 0})
+    cantidades = dict(zip(ajuste["Item"], ajuste["Cantidad ajustada"]))
+    assert cantidades["2.1"] == 1
+    assert sorted([cantidades["1.1"], cantidades["1.2"]]) == [0, 1]
+
+
+def test_reducir_redondea_unidades_hacia_abajo(construir_catalogo, almacen_completo):
+    catalogo = construir_catalogo([[(1_000, "UN", "USUARIO", ""), (1_000, "M2", "USUARIO", "")]])
+    almacen = almacen_completo(catalogo, cantidad=10.0)
+    ajuste = script.ajustar_presupuesto(catalogo, almacen, 15_500, reducir=True)
+    cantidades = dict(zip(ajuste["Item"], ajuste["Cantidad ajustada"]))
+    assert ajuste["Costo ajustado"].sum() <= 15_500
+    assert sorted(cantidades.values()) in ([5.0, 10.0], [5.5, 10.0])
+    for item, cantidad in cantidades.items():
+        if catalogo.unidades[catalogo.buscar(item)] == "UN":
+            assert cantidad == int(cantidad)
+
+
+def test_aplicar_ajuste_quita_y_reduce(construir_catalogo, almacen_completo):
+    catalogo = construir_catalogo([[(1_000, "M2", "USUARIO", ""), (3_000, "M2", "USUARIO", "")]])
+    almacen = almacen_completo(catalogo, cantidad=1.0)
+    ajuste = script.ajustar_presupuesto(catalogo, almacen, 3_500, reducir=True)
+    script.aplicar_ajuste(almacen, catalogo, ajuste)
+    assert almacen.subtotales(catalogo.valores).sum() <= 3_500
@@ -0,0 +1,93 @@
+import json
+
+import numpy as np
+import pytest
+
+import script
+
+
+@pytest.fixture
+def vivienda(construir_catalogo):
+    catalogo = construir_catalogo([[(1_000, "M2", "USUARIO", ""), (2_000, "UN", "USUARIO", "")]])
+    almacen = script.AlmacenCantidades(["#SALA", "#COCINA"], len(catalogo), activas=[True, False])
+    almacen.fijar_seleccion("#SALA", catalogo.buscar("1.1"), True)
+    almacen.fijar_cantidad("#SALA", catalogo.buscar("1.1"), 12.5)
+    almacen.fijar_seleccion("#SALA", catalogo.buscar("1.2"), True)
+    almacen.fijar_cantidad("#SALA", catalogo.buscar("1.2"), 3)
+    almacen.alturas[0] = 2.4
+    almacen.porcentaje = 10.0
+    return catalogo, almacen
+
+
+def nuevo_almacen(catalogo):
+    return script.AlmacenCantidades(["#SALA", "#COCINA"], len(catalogo))
+
+
+def escribir(ruta, lineas):
+    ruta.write_text("\n".join(lineas) + "\n", encoding="utf-8")
+
+
+def test_ida_y_vuelta(tmp_path, vivienda):
+    catalogo, almacen = vivienda
+    ruta = tmp_path / "proyecto.jsonl"
+    escribir(ruta, script.estado_proyecto(almacen, catalogo, {"vivienda": "Casa"}))
+
+    restaurado = nuevo_almacen(catalogo)
+    script.cargar_proyecto(str(ruta), restaurado, catalogo)
+    np.testing.assert_array_equal(restaurado.seleccion, almacen.seleccion)
+    np.testing.assert_array_equal(restaurado.cantidades, almacen.cantidades)
+    np.testing.assert_array_equal(restaurado.activas, almacen.activas)
+    assert restaurado.alturas[0] == 2.4
+    assert restaurado.porcentaje == 10.0
+    assert restaurado.cambios == []  # Lo restaurado no se vuelve a guardar
+
+
+def test_linea_truncada_se_ignora(tmp_path, vivienda):
+    catalogo, almacen = vivienda
+    ruta = tmp_path / "proyecto.jsonl"
+    lineas = script.estado_proyecto(almacen, catalogo, {})
+    cambio = json.dumps({"t": "cantidad", "h": "#SALA", "a": "1.1", "v": 20.0})
+    # Corte a mitad de escritura: la última línea queda incompleta
+    escribir(ruta, lineas + [cambio, cambio[:15]])
+
+    restaurado = nuevo_almacen(catalogo)
+    eventos = script.cargar_proyecto(str(ruta), restaurado, catalogo)
+    assert eventos == len(lineas)  # Cabecera no cuenta; el cambio completo sí
+    assert restaurado.cantidad("#SALA", catalogo.buscar("1.1")) == 20.0
+
+
+def test_ultimo_valor_gana_e_ignora_lo_que_no_existe(tmp_path, vivienda):
+    catalogo, almacen = vivienda
+    ruta = tmp_path / "proyecto.jsonl"
+    eventos = [
+        {"t": "seleccion", "h": "#SALA", "a": "1.1", "v": True},
+        {"t": "seleccion", "h": "#SALA", "a": "1.1", "v": False},
+        {"t": "cantidad", "h": "#PATIO", "a": "1.1", "v": 5.0},
+        {"t": "cantidad", "h": "#SALA", "a": "9.9", "v": 5.0},
+    ]
+    escribir(ruta, [json.dumps({"t": "proyecto", "version": 1})] + [json.dumps(e) for e in eventos])
+
+    restaurado = nuevo_almacen(catalogo)
+    script.cargar_proyecto(str(ruta), restaurado, catalogo)
+    assert not restaurado.seleccion.any()
+    assert np.isnan(restaurado.cantidades).all()
+
+
+def test_guardar_anexa_y_compacta(tmp_path, vivienda, monkeypatch):
+    catalogo, almacen = vivienda
+    ruta = str(tmp_path / "proyectos" / "proyecto.jsonl")
+    script.guardar_proyecto(ruta, almacen, catalogo, {})
+    compacto = len(open(ruta, encoding="utf-8").readlines())
+
+    almacen.fijar_cantidad("#SALA", catalogo.buscar("1.1"), 14.0)
+    script.guardar_proyecto(ruta, almacen, catalogo, {})
+    assert len(open(ruta, encoding="utf-8").readlines()) == compacto + 1
+
+    monkeypatch.setattr(script, "MAX_LINEAS_PROYECTO", compacto)
+    almacen.fijar_cantidad("#SALA", catalogo.buscar("1.1"), 15.0)
+    script.guardar_proyecto(ruta, almacen, catalogo, {})
+    assert len(open(ruta, encoding="utf-8").readlines()) == compacto
+
+    restaurado = nuevo_almacen(catalogo)
+    script.cargar_proyecto(ruta, restaurado, catalogo)
+    assert restaurado.cantidad("#SALA", catalogo.buscar("1.1")) == 15.0
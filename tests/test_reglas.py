@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+import script
+
+
+@pytest.mark.parametrize("area, medicion, regla, esperada", [
+    ("MAGICPLAN - ÁREA PISO", "", "", "M"),
+    ("USUARIO", "", "", "U"),
+    ("", "", "", "U"),
+    ("MAGICPLAN - ÁREA PISO", "L*L*H", "", "M*H"),
+    ("USUARIO", "L*L", "", "U"),
+    ("MAGICPLAN - ÁREA PISO", "L*2", "", "U*2"),
+    ("MAGICPLAN - ÁREA PISO", "L*.60", "", "U*.60"),
+    ("MAGICPLAN - ÁREA PISO", "L*L*H", " area_piso*1.1 ", "AREA_PISO*1.1"),
+])
+def test_expresion_catalogo(area, medicion, regla, esperada):
+    assert script.expresion_catalogo(area, medicion, regla) == esperada
+
+
+def test_alias_medida():
+    assert script.alias_medida("MAGICPLAN - ÁREA PISO") == "AREA_PISO"
+    assert script.alias_medida("MAGICPLAN - PERIMETRO CUBIERTA") == "PERIMETRO_CUBIERTA"
+
+
+def test_regla_evalua_vectores():
+    regla = script.ReglaCantidad("M*H", "MAGICPLAN - ÁREA PISO")
+    resultado = regla.evaluar({"M": np.array([10.0, 4.0]), "H": np.array([2.5, np.nan])})
+    assert resultado[0] == 25.0 and np.isnan(resultado[1])
+    assert regla.usa_altura and not regla.usa_usuario
+    assert regla.descripcion() == "ÁREA PISO × altura"
+
+
+@pytest.mark.parametrize("expresion", [
+    "__import__('os').system('true')",
+    "M.real",
+    "M if H else U",
+    "'texto'",
+    "M**2",
+    "M*",
+])
+def test_regla_rechaza_expresiones_no_permitidas(expresion):
+    with pytest.raises(ValueError):
+        script.ReglaCantidad(expresion, "MAGICPLAN - ÁREA PISO")
+
+
+def test_regla_rechaza_variables_desconocidas():
+    with pytest.raises(ValueError, match="desconocidas"):
+        script.ReglaCantidad("AREA_JARDIN*2")
+
+
+def test_regla_con_m_requiere_medida():
+    with pytest.raises(ValueError):
+        script.ReglaCantidad("M*H")
+
+
+def test_regla_invalida_del_catalogo_pide_valor(construir_catalogo):
+    catalogo = construir_catalogo([[(1_000, "M2", "MAGICPLAN - ÁREA PISO", "L*L*Z")]])
+    fila = catalogo.buscar("1.1")
+    assert catalogo.errores_reglas and catalogo.errores_reglas[0][0] == "1.1"
+    assert catalogo.reglas[fila].expresion == "U"
+
+
+def test_cantidades_por_defecto(construir_catalogo):
+    catalogo = construir_catalogo([[
+        (1_000, "M2", "MAGICPLAN - ÁREA PISO", ""),
+        (1_000, "M2", "MAGICPLAN - ÁREA PISO", "L*L*H"),
+        (1_000, "UN", "USUARIO", ""),
+    ]])
+    medidas = ["MAGICPLAN - ÁREA PISO"]
+    propiedades = script.PropiedadesHabitaciones(["#SALA", "#BAÑO"], medidas, np.array([[11.54], [-1.0]]))
+    matriz = script.cantidades_por_defecto(catalogo, propiedades, ["#SALA", "#BAÑO"], [2.34, np.nan])
+    piso, por_altura, usuario = (catalogo.buscar(item) for item in ("1.1", "1.2", "1.3"))
+    assert matriz[0, piso] == 11.54
+    assert matriz[0, por_altura] == pytest.approx(11.54 * 2.34)
+    assert matriz[1, piso] == 0.0  # Nunca negativa
+    assert np.isnan(matriz[1, por_altura])  # Falta la altura
+    assert np.isnan(matriz[:, usuario]).all()  # La escribe el usuario
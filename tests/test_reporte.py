@@ -0,0 +1,46 @@
+import os
+
+import pytest
+
+import script
+
+RUTA_PLANTILLA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Plantilla_Turbo_Final.xlsx")
+
+
+@pytest.fixture(scope="module")
+def plantilla():
+    return script.PlantillaReporte(RUTA_PLANTILLA)
+
+
+def test_libro_clonado_crea_dimensiones(plantilla):
+    ws = plantilla.nuevo_libro().active
+    ws.row_dimensions[500].height = 20
+    ws.column_dimensions["ZZ"].width = 12
+    assert ws.row_dimensions[500].index == 500
+    assert ws.column_dimensions["ZZ"].index == "ZZ"
+
+
+def test_libros_clonados_son_independientes(plantilla):
+    primero = plantilla.nuevo_libro().active
+    segundo = plantilla.nuevo_libro().active
+    primero["A31"] = "cambio"
+    assert segundo["A31"].value != "cambio"
+
+
+def test_ampliar_area_datos_baja_alturas(plantilla):
+    ws = plantilla.nuevo_libro().active
+    alturas = {fila: ws.row_dimensions[fila].height for fila in range(script.FILA_COSTO_DIRECTO, ws.max_row + 1)}
+    script.ampliar_area_datos(ws, 5)
+    for fila, altura in alturas.items():
+        assert ws.row_dimensions[fila + 5].height == altura
+
+
+def test_ampliar_area_datos_copia_estilo_de_las_filas(plantilla):
+    ws = plantilla.nuevo_libro().active
+    ultima = script.FILA_COSTO_DIRECTO - 1
+    script.ampliar_area_datos(ws, 5)
+    for fila in range(ultima, ultima + 5):
+        assert ws.cell(fila, 15).border.right.style == "thin"
+        assert ws.cell(fila, 15).border.bottom.style is None
+    assert ws.cell(ultima + 5, 15).border.right.style == "thin"
+    assert ws.cell(ultima + 5, 15).border.bottom.style == "thin"